@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+""" End to end benchmark of the collector's checks over synthetic, full DFZ sized inputs
+    Generates a table.jsonl of ~1M v4 and 200k v6 routes with MOAS and anycast prefixes and a long tail of
+    origin ASNs, plus Routinator and Atlas payloads, and replays them through each stage for a number of
+    cycles. Every stage's wall time, CPU time and peak RSS is written to a JSON file, which --compare
+    diffs against an earlier run to show regressions between versions"""
+import argparse
+import numpy as np
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import ujson
+import zipfile
+
+import main
+import mock_upstream
+
+v4_routes = 1000000
+v6_routes = 200000
+cycles = 5
+seed = 1
+asn_count = 80000               # Distinct origin ASNs, picked with a Zipf distribution so a few originate most routes
+zipf_exponent = 1.3
+moas_share = 0.01               # Share of prefixes originated by 2-3 ASNs
+anycast_share = 0.001           # Share of prefixes originated by 5-20 ASNs
+churn_share = 0.005             # Share of prefixes withdrawn in any one cycle
+hijack_share = 0.0002           # Share of single origin prefixes that gain a second origin in any one cycle
+results_path = 'benchmark.json'
+
+headers = {'User-Agent': 'howfuckedistheinternet.com benchmark'}
+
+
+def random_prefixes(rng, count, family):
+    """ count unique prefixes as CIDR strings, mostly /24s for v4 and /48s for v6 like the real DFZ """
+
+    prefixes = np.empty(0, dtype=np.uint64)
+    while len(prefixes) < count:
+        n = count - len(prefixes) + count // 50
+        if family == 4:
+            lengths = np.where(rng.random(n) < 0.6, 24, rng.integers(16, 24, n)).astype(np.uint64)
+            # Unicast space only, 1.0.0.0 to 223.255.255.255
+            networks = rng.integers(1 << 24, 224 << 24, n, dtype=np.uint64)
+            networks &= ~((np.uint64(1) << (np.uint64(32) - lengths)) - np.uint64(1))
+            keys = (networks << np.uint64(8)) | lengths
+        else:
+            lengths = np.where(rng.random(n) < 0.55, 48, rng.integers(29, 48, n)).astype(np.uint64)
+            # Top 64 bits of an address in 2000::/3, the low 16 are always zero so the length fits there
+            networks = np.uint64(1 << 61) | rng.integers(0, 1 << 61, n, dtype=np.uint64)
+            networks &= ~((np.uint64(1) << (np.uint64(64) - lengths)) - np.uint64(1))
+            keys = networks | lengths
+        prefixes = np.unique(np.concatenate([prefixes, keys]))
+    prefixes = rng.permutation(prefixes)[:count]
+
+    if family == 4:
+        lengths = prefixes & np.uint64(0xff)
+        networks = prefixes >> np.uint64(8)
+        octets = [(networks >> np.uint64(shift)) & np.uint64(0xff) for shift in (24, 16, 8, 0)]
+        return [f"{a}.{b}.{c}.{d}/{length}" for a, b, c, d, length in zip(*(o.tolist() for o in octets),
+                                                                              lengths.tolist())]
+    lengths = prefixes & np.uint64(0xffff)
+    hextets = [(prefixes >> np.uint64(shift)) & np.uint64(0xffff) for shift in (48, 32, 16)]
+    return [f"{a:x}:{b:x}:{c:x}::/{length}" for a, b, c, length in zip(*(h.tolist() for h in hextets),
+                                                                         lengths.tolist())]
+
+
+def synthetic_dfz(rng):
+    """ The base routing table as (prefixes, prefix index per route, origin ASN per route) """
+
+    prefixes = random_prefixes(rng, v4_routes, 4) + random_prefixes(rng, v6_routes, 6)
+
+    origins = np.ones(len(prefixes), dtype=np.int64)
+    kind = rng.random(len(prefixes))
+    moas = kind < moas_share
+    anycast = kind > 1 - anycast_share
+    origins[moas] = rng.integers(2, 4, moas.sum())
+    origins[anycast] = rng.integers(5, 21, anycast.sum())
+
+    asns = rng.choice(np.arange(1, 400000), asn_count, replace=False)
+    ranks = np.minimum(rng.zipf(zipf_exponent, origins.sum()), asn_count) - 1
+
+    return prefixes, np.repeat(np.arange(len(prefixes)), origins), asns[ranks]
+
+
+def cycle_table(rng, dfz):
+    """ table.jsonl for one cycle, the base table with some prefixes withdrawn and a few gaining an extra origin """
+
+    prefixes, route_prefix, route_asn = dfz
+    withdrawn = rng.random(len(prefixes)) < churn_share
+    keep = ~withdrawn[route_prefix]
+    route_prefix = route_prefix[keep]
+    route_asn = route_asn[keep]
+
+    hijacked = np.flatnonzero(rng.random(len(prefixes)) < hijack_share)
+    hijacked = hijacked[~withdrawn[hijacked]]
+    route_prefix = np.concatenate([route_prefix, hijacked])
+    route_asn = np.concatenate([route_asn, rng.integers(1, 400000, len(hijacked))])
+
+    hits = rng.integers(1, 5000, len(route_prefix))
+    lines = [f'{{"CIDR":"{prefixes[p]}","ASN":{a},"Hits":{h}}}'
+             for p, a, h in zip(route_prefix.tolist(), route_asn.tolist(), hits.tolist())]
+    return ('\n'.join(lines) + '\n').encode()
+
+
+def write_recordings(path, cycle, table, rng):
+    """ One stored (uncompressed) recording per source for the cycle, keyed the way main.py replays them """
+
+    recordings = {}
+    for source in ('bgp', 'rpki', 'atlas_roots', 'atlas_probes'):
+        recordings[source] = os.path.join(path, f"cycle{cycle}-{source}.zip")
+        with zipfile.ZipFile(recordings[source], 'w', compression=zipfile.ZIP_STORED) as zf:
+            for served_source, url in mock_upstream.upstream_paths().values():
+                if served_source != source:
+                    continue
+                if source == 'bgp':
+                    body = table
+                elif source == 'rpki':
+                    body = mock_upstream.synthetic_rpki(rng)
+                elif source == 'atlas_probes':
+                    body = mock_upstream.synthetic_probe_status(rng)
+                else:
+                    body = mock_upstream.synthetic_root_measurement(rng)
+                zf.writestr(main.url_key(url), body)
+    return recordings
+
+
+def reset_peak_rss():
+    """ Resets the kernel's RSS high water mark, so the next reading is the peak of one stage alone """
+    try:
+        with open('/proc/self/clear_refs', 'w') as cf:
+            cf.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def rss():
+    """ (current, peak) RSS in bytes, the peak since the last reset_peak_rss() """
+    try:
+        with open('/proc/self/status') as sf:
+            status = dict(line.split(':', 1) for line in sf)
+        return int(status['VmRSS'].split()[0]) * 1024, int(status['VmHWM'].split()[0]) * 1024
+    except (OSError, KeyError):
+        # Without /proc the peak is the peak of the whole run so far
+        return None, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure(timings, stage, fn, *args):
+    reset_peak_rss()
+    rss_before, _ = rss()
+    wall, cpu = time.perf_counter(), time.process_time()
+    result = fn(*args)
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    _, peak = rss()
+    timings[stage] = {'wall': round(wall, 4), 'cpu': round(cpu, 4), 'rss_before': rss_before, 'peak_rss': peak}
+    return result
+
+
+def run_cycle(histories, scoreboard, index, written, last_changed, recordings):
+    """ Runs every stage over one cycle's recordings, the way the collector's stage functions would """
+
+    timings = {}
+    for source, path in recordings.items():
+        main.replay_archives[source] = zipfile.ZipFile(path)
+
+    packed, _, _, _ = measure(timings, 'fetch_bgp_table', main.fetch_bgp_snapshot, main.bgp_table_url, headers)
+    table = measure(timings, 'unpack', main.BGPTable.unpack, packed, histories['origins'].keys,
+                    histories['prefixes'].keys)
+    del packed
+    _, origins = measure(timings, 'check_bgp_origins', main.check_bgp_origins, table, histories['origins'])
+    _, prefixes = measure(timings, 'check_bgp_prefixes', main.check_bgp_prefixes, table, histories['prefixes'])
+    _, dfz = measure(timings, 'check_dfz', main.check_dfz, table, histories['dfz'])
+    del table
+    measure(timings, 'evict', lambda: [main.evict_stale(name, histories[name], 'bgp')
+                                       for name in ('origins', 'prefixes')])
+
+    def rpki():
+        invalid_roa, total_roa, _ = main.fetch_rpki_roa(main.routinator_api_url, headers)
+        _, invalid = main.check_rpki_invalids(invalid_roa, histories['invalid_roa'])
+        _, total = main.check_rpki_totals(total_roa, histories['total_roa'])
+        return invalid, total
+
+    def dns_roots():
+        v6_roots_failed, v4_roots_failed, _ = main.fetch_root_dns(main.ripe_atlas_api_url, headers)
+        return main.check_dns_roots(v6_roots_failed, v4_roots_failed), v6_roots_failed, v4_roots_failed
+
+    def atlas_probes():
+        probe_status, _ = main.fetch_ripe_atlas_status(main.ripe_atlas_api_url, headers)
+        return main.check_ripe_atlas_status(probe_status)
+
+    invalid, total = measure(timings, 'rpki', rpki)
+    dns_root, v6_roots_failed, v4_roots_failed = measure(timings, 'dns_roots', dns_roots)
+    atlas_connected = measure(timings, 'atlas_probes', atlas_probes)
+
+    for source in recordings:
+        main.replay_archives.pop(source).close()
+
+    reasons = {'origins': origins, 'prefixes': prefixes, 'dfz': dfz, 'invalid_roa': invalid, 'total_roa': total,
+               'dns_root': dns_root, 'atlas_connected': atlas_connected}
+
+    # Turning the histories back into per-key lists is the costliest step of publishing, so it's a stage of its own
+    def to_dict():
+        return {'bgp': {'origins': histories['origins'].to_dict(), 'prefixes': histories['prefixes'].to_dict()},
+                'rpki': {'invalid_roa': histories['invalid_roa'].to_dict(),
+                         'total_roa': histories['total_roa'].to_dict()},
+                'atlas': {'dns_roots': {'v6': v6_roots_failed, 'v4': v4_roots_failed}}}
+
+    results = measure(timings, 'to_dict', to_dict)
+    documents = measure(timings, 'encode', main.shard_results, results)
+    del results
+
+    def write():
+        for metric, metric_reasons in reasons.items():
+            scoreboard.update(metric, metric_reasons)
+        changed = {path: document for path, document in documents.items()
+                   if index['documents'].get(path, {}).get('sha1') != document[0]}
+        files = {main.status_file: main.digested(scoreboard.status + '\n'),
+                 main.why_file: main.digested(main.render_why(scoreboard.reasons, scoreboard.staleness())),
+                 main.timestamp_file: main.digested(main.render_timestamp(0))}
+        files.update(main.index_documents(changed, index))
+        files[main.results_file] = main.digested(ujson.dumps({'status': scoreboard.status,
+                                                              'metrics': {'weighted': scoreboard.weighted_reasons,
+                                                                          'unweighted': scoreboard.unweighted_reasons,
+                                                                          'documents_written': len(changed)},
+                                                              'index': main.results_dir + 'index.json'}))
+        files = main.skip_unchanged(files, written, last_changed)
+        main.write_files(files)
+
+    measure(timings, 'write_outputs', write)
+    timings['reasons'] = {metric: len(metric_reasons) for metric, metric_reasons in reasons.items()}
+
+    return timings
+
+
+def summarise(runs):
+    """ Median and worst wall and CPU time, and the worst peak RSS, of each stage over every cycle """
+    summary = {}
+    for stage in runs[0]:
+        if stage == 'reasons':
+            continue
+        summary[stage] = {'wall_median': float(np.median([run[stage]['wall'] for run in runs])),
+                          'wall_max': max(run[stage]['wall'] for run in runs),
+                          'cpu_median': float(np.median([run[stage]['cpu'] for run in runs])),
+                          'peak_rss_max': max(run[stage]['peak_rss'] for run in runs)}
+    return summary
+
+
+def revision():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(baseline_path, summary):
+    """ Prints each stage's median wall time and worst peak RSS against an earlier run's """
+    with open(baseline_path) as bf:
+        baseline = ujson.load(bf)
+    print(f"{'stage':<20} {'wall (s)':>22} {'peak RSS (MiB)':>24}    against {baseline['meta']['revision']}")
+    for stage, now in summary.items():
+        before = baseline['summary'].get(stage)
+        if not before:
+            continue
+        wall = f"{before['wall_median']:.3f} -> {now['wall_median']:.3f}"
+        peak = f"{before['peak_rss_max'] / 2**20:.0f} -> {now['peak_rss_max'] / 2**20:.0f}"
+        change = (now['wall_median'] / before['wall_median'] - 1) * 100 if before['wall_median'] else 0
+        print(f"{stage:<20} {wall:>22} {peak:>24}    {change:+.0f}%")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks every stage over synthetic full DFZ sized inputs')
+    parser.add_argument('--cycles', type=int, default=cycles)
+    parser.add_argument('--v4-routes', type=int, default=v4_routes)
+    parser.add_argument('--v6-routes', type=int, default=v6_routes)
+    parser.add_argument('--atlas-probes', type=int, default=12000, help='probes in each Atlas measurement')
+    parser.add_argument('--seed', type=int, default=seed)
+    parser.add_argument('--output', default=results_path, help='where to write the results as JSON')
+    parser.add_argument('--compare', metavar='JSON', help='an earlier run to compare this one against')
+    args = parser.parse_args()
+
+    v4_routes, v6_routes = args.v4_routes, args.v6_routes
+    mock_upstream.atlas_probes = args.atlas_probes
+    main.debug = False
+    started = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    rng = np.random.default_rng(args.seed)
+    payload_rng = random.Random(args.seed)
+
+    with tempfile.TemporaryDirectory() as scratch:
+        main.root = os.path.join(scratch, 'www') + '/'
+        main.state_root = os.path.join(scratch, 'state') + '/'
+        os.makedirs(main.root)
+
+        before = time.perf_counter()
+        dfz = synthetic_dfz(rng)
+        print(f"generated {len(dfz[1])} routes over {len(dfz[0])} prefixes in {time.perf_counter() - before:.1f}s",
+              file=sys.stderr)
+
+        histories = main.new_histories()
+        scoreboard = main.Scoreboard(list(main.weighting))
+        index = main.new_results_index()
+        written, last_changed = {}, {}
+        runs = []
+        for cycle in range(args.cycles):
+            recordings = write_recordings(scratch, cycle, cycle_table(rng, dfz), payload_rng)
+            runs.append(run_cycle(histories, scoreboard, index, written, last_changed, recordings))
+            for path in recordings.values():
+                os.remove(path)
+            print(f"cycle {cycle}: " + ', '.join(f"{stage} {timing['wall']:.2f}s"
+                                                 for stage, timing in runs[-1].items() if stage != 'reasons'),
+                  file=sys.stderr)
+
+    summary = summarise(runs)
+    results = {'meta': {'revision': revision(), 'started': started,
+                        'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+                        'peak_rss_per_stage': reset_peak_rss()},
+               'params': {'cycles': args.cycles, 'v4_routes': v4_routes, 'v6_routes': v6_routes,
+                          'atlas_probes': args.atlas_probes, 'seed': args.seed, 'asn_count': asn_count,
+                          'zipf_exponent': zipf_exponent, 'moas_share': moas_share, 'anycast_share': anycast_share,
+                          'churn_share': churn_share, 'hijack_share': hijack_share},
+               'cycles': runs,
+               'summary': summary}
+    with open(args.output, 'w') as rf:
+        ujson.dump(results, rf, indent=2)
+
+    if args.compare:
+        compare(args.compare, summary)
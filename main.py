@@ -1,8 +1,27 @@
 #!/usr/bin/env python3
+import argparse
+import hashlib
+import http.server
+import io
 import math
+import multiprocessing
+import numpy as np
+import os
+import queue
+import random
 import requests
+import shutil
+import socket
+import sys
+import tempfile
+import threading
 import time
 import ujson
+import zipfile
+import zlib
+from array import array
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, timezone
 
 routinator_api_url = 'https://rpki-validator.ripe.net/api/v1/status'
@@ -13,46 +32,349 @@ status_file = 'status.txt'
 why_file = 'why.txt'
 timestamp_file = 'timestamp.txt'
 results_file = 'results.json'
+last_changed_file = 'last_changed.json'
+deltas_file = 'deltas.json'
+deltas_dir = 'deltas/'          # One file per delta, named for its sequence number
+index_file = 'index.html'       # Pre-rendered html/index.py, for serving as a static file
+header_file = 'header.html'     # Templates html/index.py wraps the page in, read from root like it does
+footer_file = 'footer.html'
+results_dir = 'results/'        # Detail documents indexed from results.json
+state_root = '/var/lib/howfuckedistheinternet.com/'
+history_file = 'history.npz'
+history_schema_version = 2
+http_cache_dir = 'http_cache/'
+recordings_dir = 'recordings/'
+recording_manifest = 'urls.json'  # In each recording, the upstream_name of every url recorded -> its entry
 
 max_history = 24                # 12hrs at regular 30min updates
+evict_after = 86400             # Seconds a prefix, ASN or repo can go unseen before it's dropped from history
 update_frequency = 1800         # 30 mins
 dfz_threshold = 1               # Threshold of routes in the DFZ (% increase or decrease)
 bgp_prefix_threshold = 85       # Threshold of prefix decrease before alerting (%)
 dns_root_fail_threshold = 20    # Threshold of RIPE Atlas Probes failing to reach root-servers (%)
 atlas_probe_threshold = 10      # Threshold of RIPE Atlas Probes disconnected (%)
 total_roa_threshold = 90        # Threshold of published RPKI ROA decrease (%)
+ingest_chunk_size = 65536       # Bytes read from the bgp.tools stream at a time
+atlas_concurrency = 8           # Max RIPE Atlas requests in flight at once, keep within Atlas rate limits
+http_retries = 3                # Retries after a connection error, timeout, 429 or 5xx
+http_backoff = 2                # Base seconds of the jittered exponential backoff between retries
+slot_tolerance = 1              # Seconds early a scheduled run can wake and still count as on its slot
+timings_history = 48            # Runs of each source's stage timings kept in results.json
+deltas_kept = 96                # Publishes' deltas kept under deltas_dir for consumers to catch up from
+delta_keys_limit = 10000        # Keys listed per history in a delta, past it consumers refetch its documents
+results_shards = 64             # Documents each per-prefix and per-ASN history is spread over, by crc32 of the key
+sharded_results = ('origins', 'prefixes')
+
+# Refresh interval (seconds) and history window (samples) per source. The Atlas results change every few
+# minutes so are polled often, while the expensive BGP table keeps the regular 30min cadence
+# Past its deadline (seconds) a source's last reasons are published as stale while it carries on in the background
+schedules = {'bgp': {'interval': update_frequency, 'history': max_history, 'deadline': 600},
+             'rpki': {'interval': 600, 'history': 72, 'deadline': 120},          # 12hrs at 10min updates
+             'atlas_roots': {'interval': 300, 'deadline': 60},
+             'atlas_probes': {'interval': 300, 'deadline': 60}}
+
+# Connect and read timeouts (seconds) per upstream source
+http_timeouts = {'bgp': (10, 120), 'rpki': (10, 60), 'atlas_roots': (10, 30), 'atlas_probes': (10, 30)}
 
 bgp_enabled = True
 rpki_enabled = True
 atlas_enabled = True
 write_enabled = True
+persist_enabled = True
+http_cache_enabled = True
+metrics_enabled = True          # Serve Prometheus metrics on metrics_address:metrics_port/metrics
+metrics_address = '127.0.0.1'
+metrics_port = 9464
+record_enabled = False          # Archive every upstream body each stage fetches under recordings_dir, for replay
+replay_from = None              # Directory of recordings to run the checks over instead of fetching upstream
+bgp_parse_worker = True         # Parse the BGP table in a worker process, off the main process' GIL
 debug = True
 
+# One keep-alive connection pool per upstream host, shared by every fetcher
+http_session = requests.Session()
+http_session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=atlas_concurrency))
+http_session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=atlas_concurrency))
+
+# Url, status, attempts, latency and bytes of every request made by each source's latest run, reset by its stage
+# Every source has its list from the start, so stage threads never add keys while publishing iterates over them
+http_log = {source: [] for source in http_timeouts}
+
+# Url -> (sha256 of the body, representation parsed from it) for every document fetched through fetch_parsed
+http_parsed = {}
+
+# Source -> recording (ZipFile) its fetches are currently being replayed from
+replay_archives = {}
+
+# Held by a stage while it pushes to or evicts from its histories, and while the histories are checkpointed,
+# so a checkpoint never catches a history with its keys and samples out of step
+history_lock = threading.Lock()
+
+# Prometheus text exposition of the latest publish, swapped in whole so a scrape never sees half of one
+metrics_exposition = b''
+
 # Adjust weighting based on importance
 weighting = {'origins': 0.1, 'prefixes': 0.2, 'dns_root': 10, 'atlas_connected': 1,
              'invalid_roa': 1, 'total_roa': 5, 'dfz': 1}
 
 
+def http_get(source, url, headers, stream=False):
+    """ GETs url through the shared session using the source's timeouts
+        Connection errors, timeouts, 429s and 5xx responses are retried up to http_retries times with full
+        jitter backoff, any other error status is raised straight away. Every request is recorded in http_log,
+        streamed responses carry their log entry as fetch_log so the reader can fill in bytes once consumed"""
+
+    entry = {'url': url, 'status': None, 'attempts': 0, 'latency': 0.0, 'bytes': 0}
+    http_log.setdefault(source, []).append(entry)
+
+    for attempt in range(http_retries + 1):
+        entry['attempts'] = attempt + 1
+        before = time.monotonic()
+        try:
+            response = http_session.get(url, headers=headers, timeout=http_timeouts[source], stream=stream)
+            entry['status'] = response.status_code
+            if response.status_code == 429 or response.status_code >= 500:
+                response.close()
+                raise requests.HTTPError(f"{response.status_code} from {url}", response=response)
+            response.raise_for_status()
+            if not stream:
+                entry['bytes'] = len(response.content)
+            entry['latency'] = time.monotonic() - before
+            response.fetch_log = entry
+            return response
+        except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+            entry['latency'] = time.monotonic() - before
+            retryable = not isinstance(e, requests.HTTPError) or e.response.status_code == 429 or \
+                e.response.status_code >= 500
+            if not retryable or attempt == http_retries:
+                raise
+            if debug:
+                print(f"retrying {url} after {e}")
+            time.sleep(random.uniform(0, http_backoff * 2 ** attempt))
+
+
+def url_key(url):
+    """ Name a url's body is kept under, in the HTTP cache and in recordings """
+    return hashlib.sha1(url.encode()).hexdigest()
+
+
+def upstream_name(url):
+    """ A url relative to the upstream it's fetched from, what recordings are matched on so they replay
+        whichever upstream (e.g. --upstream) they were recorded against or are replayed with"""
+    for name, base in (('bgp/table.jsonl', bgp_table_url), ('rpki/status', routinator_api_url),
+                       ('atlas/measurements/', ripe_atlas_api_url)):
+        if url.startswith(base):
+            return name + url[len(base):]
+    return url
+
+
+def recorded_entry(recording, url):
+    """ Name of the entry holding url's body in a recording, None if it wasn't recorded
+        Recordings from before the manifest only match the exact url they were recorded from"""
+    try:
+        manifest = ujson.loads(recording.read(recording_manifest))
+    except KeyError:
+        return url_key(url) if url_key(url) in recording.namelist() else None
+    return manifest.get(upstream_name(url))
+
+
+class CachedFetch:
+    """ Conditional GET backed by an on-disk cache of bodies and their ETag/Last-Modified validators
+        The body is streamed in chunks, from upstream on a 200 (written through to the cache as it arrives)
+        or from the cached copy on a 304. Once the body has been consumed `digest` holds its sha256, so
+        callers can tell a byte-identical body from a changed one whichever way it arrived
+        While a source is being replayed the body is streamed from its recording instead"""
+
+    def __init__(self, source, url, headers):
+        self.url = url
+        self.path = state_root + http_cache_dir + url_key(url)
+        self.meta = {}
+        self.digest = None
+        self.replay = replay_archives.get(source)
+        self.response = None
+        self.not_modified = False
+
+        if self.replay:
+            # A fetch that failed when it was recorded has no body, and fails again in the replay
+            self.entry = recorded_entry(self.replay, url)
+            if self.entry is None:
+                raise requests.ConnectionError(f"{url} is not in the recording being replayed")
+            size = self.replay.getinfo(self.entry).file_size
+            http_log.setdefault(source, []).append({'url': url, 'status': 200, 'attempts': 0,
+                                                    'latency': 0.0, 'bytes': size})
+            return
+
+        if http_cache_enabled:
+            try:
+                with open(self.path + '.meta', encoding='utf-8') as mf:
+                    self.meta = ujson.load(mf)
+            except (OSError, ValueError):
+                pass
+
+        headers = dict(headers)
+        if self.meta and os.path.exists(self.path + '.body'):
+            if self.meta.get('etag'):
+                headers['If-None-Match'] = self.meta['etag']
+            if self.meta.get('last_modified'):
+                headers['If-Modified-Since'] = self.meta['last_modified']
+
+        self.response = http_get(source, url, headers, stream=True)
+        self.not_modified = self.response.status_code == 304
+        if self.not_modified:
+            self.digest = self.meta.get('digest')
+
+    def iter_chunks(self):
+        if self.replay:
+            sha = hashlib.sha256()
+            with self.replay.open(self.entry) as bf:
+                while chunk := bf.read(ingest_chunk_size):
+                    sha.update(chunk)
+                    yield chunk
+            self.digest = sha.hexdigest()
+            return
+
+        if self.not_modified:
+            self.response.close()
+            with open(self.path + '.body', 'rb') as bf:
+                while chunk := bf.read(ingest_chunk_size):
+                    yield chunk
+            return
+
+        sha = hashlib.sha256()
+        body = None
+        # Recording archives the bodies from the cache, so it needs them written through too. Each fetch
+        # writes its own temporary file, so concurrent fetches of one url can't rename each other's away
+        if http_cache_enabled or record_enabled:
+            os.makedirs(state_root + http_cache_dir, exist_ok=True)
+            fd, body_tmp = tempfile.mkstemp(prefix=url_key(self.url) + '.', suffix='.tmp',
+                                            dir=state_root + http_cache_dir)
+            body = os.fdopen(fd, 'wb')
+        try:
+            for chunk in self.response.iter_content(chunk_size=ingest_chunk_size):
+                sha.update(chunk)
+                if body:
+                    body.write(chunk)
+                yield chunk
+        except BaseException:
+            if body:
+                body.close()
+                os.unlink(body_tmp)
+            raise
+        finally:
+            self.response.fetch_log['bytes'] = self.response.raw.tell()
+            self.response.close()
+
+        self.digest = sha.hexdigest()
+        if body:
+            body.close()
+            os.replace(body_tmp, self.path + '.body')
+            meta = {'url': self.url, 'digest': self.digest, 'etag': self.response.headers.get('ETag'),
+                    'last_modified': self.response.headers.get('Last-Modified')}
+            with open(self.path + '.meta', 'w', encoding='utf-8') as mf:
+                ujson.dump(meta, mf)
+
+    def iter_lines(self):
+        """ Splits the body on raw newline bytes as the chunks arrive, never decoding the whole body """
+        pending = b''
+        for chunk in self.iter_chunks():
+            lines = (pending + chunk).split(b'\n')
+            pending = lines.pop()
+            yield from lines
+        if pending:
+            yield pending
+
+    def read(self):
+        return b''.join(self.iter_chunks())
+
+    def close(self):
+        if self.response:
+            self.response.close()
+
+
+def fetch_parsed(source, url, headers, parse):
+    """ Fetches a JSON document through the cache and returns (parse(document), sha256 of the body)
+        On a 304, or a body byte-identical to the last one parsed, the previous representation is reused"""
+
+    body = CachedFetch(source, url, headers)
+    digest, parsed = http_parsed.get(url, (None, None))
+    if body.not_modified and body.digest == digest:
+        body.close()
+        return parsed, digest
+
+    data = body.read()
+    if body.digest != digest:
+        parsed = parse(ujson.loads(data))
+        http_parsed[url] = (body.digest, parsed)
+
+    return parsed, body.digest
+
+
+def combined_digest(digests):
+    """ Single digest over several bodies, a failed fetch (None) counts as a change """
+    if None in digests:
+        return None
+    return hashlib.sha256(''.join(digests).encode()).hexdigest()
+
+
+def timed(timings, name, fn, *args, **kwargs):
+    """ Calls fn, recording its wall time and the calling thread's CPU time in timings under name
+        Callers add whatever counts make sense for the function (bytes, records, keys, reasons) to its entry"""
+
+    wall, cpu = time.perf_counter(), time.thread_time()
+    result = fn(*args, **kwargs)
+    timings[name] = {'wall': round(time.perf_counter() - wall, 6), 'cpu': round(time.thread_time() - cpu, 6)}
+
+    return result
+
+
+def fetched_bytes(source):
+    """ Bytes of every response body a source's latest run has read """
+    return sum(entry['bytes'] for entry in http_log.get(source, []))
+
+
+def history_hours(source):
+    """ Hours of history a source's checks average over """
+    return (schedules[source]['history'] * schedules[source]['interval']) / 60 / 60
+
+
+def next_slot(interval):
+    """ The monotonic time of the next wall clock multiple of a source's interval, so its cycles stay
+        on :00 and :30 however long each one took, and a stepped wall clock only moves the next slot"""
+
+    wall = time.time()
+    # A slot reached up to slot_tolerance early by the monotonic clock counts as reached, so it doesn't fire twice
+    return time.monotonic() + (math.floor((wall + slot_tolerance) / interval) + 1) * interval - wall
+
+
 def fetch_ripe_atlas_status(base_url, headers):
     """ Uses the RIPE Atlas built-in connection measurement id 7000 to get last seen status for probes """
 
-    probe_status = {'connected': [], 'disconnected': []}
+    def parse(results):
+        probe_status = {'connected': [], 'disconnected': []}
+        for probe in results:
+            if probe.get('event') == 'disconnect':
+                probe_status['disconnected'].append(probe.get('prb_id'))
+            if probe.get('event') == 'connect':
+                probe_status['connected'].append(probe.get('prb_id'))
+        return probe_status
 
     url = base_url + '7000/latest'
     try:
-        results = requests.get(url, headers=headers).json()
+        return fetch_parsed('atlas_probes', url, headers, parse)
     except:
+        # Raised rather than checked as no probes at all, so the last reasons carry on flagged as stale
         if debug:
             print(f"failed to fetch RIPE Atlas results from {url}")
-        return probe_status
+        raise
+
 
-    for probe in results:
-        if probe.get('event') == 'disconnect':
-            probe_status['disconnected'].append(probe.get('prb_id'))
-        if probe.get('event') == 'connect':
-            probe_status['connected'].append(probe.get('prb_id'))
+def fetch_root_dns_measurement(url, headers):
+    """ Counts the probes in the latest results of one root server measurement, and which of them failed """
 
-    return probe_status
+    def parse(results):
+        failed = [probe.get('prb_id') for probe in results if probe.get('error') is not None]
+        return {'total': len(results), 'failed': failed}
+
+    return fetch_parsed('atlas_roots', url, headers, parse)
 
 
 def fetch_root_dns(base_url, headers):
@@ -87,156 +409,602 @@ def fetch_root_dns(base_url, headers):
 
     v6_roots_failed = {}
     v4_roots_failed = {}
+    digests = []
+
+    # Each measurement downloads the latest result from every probe, so fetch them all at once
+    # over pooled keep-alive connections rather than one after another. A measurement listed for
+    # more than one server is fetched once and shared between them
+    with ThreadPoolExecutor(max_workers=atlas_concurrency) as pool:
+        fetches = {}
+        futures = []
+        for roots, roots_failed in ((v6_roots, v6_roots_failed), (v4_roots, v4_roots_failed)):
+            for measurement in roots:
+                url = base_url + str(measurement.get('id')) + '/latest/'
+                if url not in fetches:
+                    fetches[url] = pool.submit(fetch_root_dns_measurement, url, headers)
+                futures.append((fetches[url], roots_failed, measurement.get('server'), url))
+
+        error = None
+        for future, roots_failed, server, url in futures:
+            try:
+                roots_failed[server], digest = future.result()
+            except Exception as e:
+                digest = None
+                error = e
+                if debug:
+                    print(f"failed to fetch RIPE Atlas results from {url}")
+                else:
+                    pass
+            digests.append(digest)
+
+    # With nothing fetched there is nothing to check, raising leaves the last reasons in place flagged as stale
+    if not v6_roots_failed and not v4_roots_failed:
+        raise error
+
+    return v6_roots_failed, v4_roots_failed, combined_digest(digests)
 
-    for measurement in v6_roots:
-        url = base_url + str(measurement.get('id')) + '/latest/'
-        try:
-            results = requests.get(url, headers=headers).json()
-            v6_roots_failed[measurement.get('server')] = {'total': len(results), 'failed': []}
-            for probe in results:
-                if probe.get('error') is not None:
-                    v6_roots_failed[measurement.get('server')]['failed'].append(probe.get('prb_id'))
-        except:
-            if debug:
-                print(f"failed to fetch RIPE Atlas results from {url}")
-            else:
-                pass
 
-    for measurement in v4_roots:
-        url = base_url + str(measurement.get('id')) + '/latest/'
-        try:
-            results = requests.get(url).json()
-            v4_roots_failed[measurement.get('server')] = {'total': len(results), 'failed': []}
-            for probe in results:
-                if probe.get('error') is not None:
-                    v4_roots_failed[measurement.get('server')]['failed'].append(probe.get('prb_id'))
-        except:
-            if debug:
-                print(f"failed to fetch RIPE Atlas results from {url}")
-            else:
-                pass
+def fetch_rpki_roa(url, headers):
 
-    return v6_roots_failed, v4_roots_failed
+    def parse(results):
+        invalid_roa = {}
+        total_roa = {}
+
+        for repo in results.get('repositories'):
+            invalid = results['repositories'][repo].get('invalidROAs')
+            invalid_roa[repo] = invalid
+
+            valid_roa = results['repositories'][repo].get('validROAs')
+            total_roa[repo] = int(valid_roa + invalid)
+
+        return invalid_roa, total_roa
+
+    (invalid_roa, total_roa), digest = fetch_parsed('rpki', url, headers, parse)
+
+    return invalid_roa, total_roa, digest
+
+
+class Interner:
+    """ Assigns each key a dense integer id, in order of first appearance
+        Ids index straight into the typed arrays that hold per-key data"""
+
+    def __init__(self):
+        self.ids = {}
+        self.keys = []
+
+    def __len__(self):
+        return len(self.keys)
+
+    def intern(self, key):
+        key_id = self.ids.get(key)
+        if key_id is None:
+            key_id = self.ids[key] = len(self.keys)
+            self.keys.append(key)
+        return key_id
+
+    def intern_many(self, keys):
+        """ Interns a sequence of keys at once, returning their ids as an array """
+        ids = self.ids
+        all_keys = self.keys
+        key_ids = np.empty(len(keys), dtype=np.int64)
+        for i, key in enumerate(keys):
+            key_id = ids.get(key)
+            if key_id is None:
+                key_id = ids[key] = len(all_keys)
+                all_keys.append(key)
+            key_ids[i] = key_id
+        return key_ids
+
+    def compact(self, keep):
+        """ Drops the keys not flagged in the keep mask and renumbers the rest densely, in their existing order
+            Returns the bytes held by the dropped keys"""
+        keys = self.keys
+        dropped = sum(sys.getsizeof(keys[i]) for i in np.flatnonzero(~keep).tolist())
+        self.keys = [keys[i] for i in np.flatnonzero(keep).tolist()]
+        self.ids = dict(zip(self.keys, range(len(self.keys))))
+        return dropped
+
+    def dump(self, arrays, name):
+        """ Adds the keys to a dict of arrays for np.savez, ints as an array and strings as one joined blob """
+        if all(type(key) is int for key in self.keys):
+            arrays[name + '.int_keys'] = np.array(self.keys, dtype=np.int64)
+        else:
+            arrays[name + '.str_keys'] = np.frombuffer('\n'.join(self.keys).encode(), dtype=np.uint8)
 
+    def load(self, arrays, name):
+        if name + '.int_keys' in arrays:
+            keys = arrays[name + '.int_keys'].tolist()
+        else:
+            blob = arrays[name + '.str_keys'].tobytes().decode()
+            keys = blob.split('\n') if blob else []
+        self.keys = keys
+        self.ids = dict(zip(keys, range(len(keys))))
+
+
+class PrefixInterner(Interner):
+    """ Interns CIDR strings and keeps each prefix integer encoded as (family, network, length)
+        IPv6 networks don't fit a single machine word so are split into high and low 64 bits"""
+
+    def __init__(self):
+        super().__init__()
+        self.family = array('B')
+        self.net_hi = array('Q')
+        self.net_lo = array('Q')
+        self.length = array('B')
+
+    def intern(self, key):
+        """ Raises ValueError or OSError for a malformed prefix, before anything is interned """
+        key_id = self.ids.get(key)
+        if key_id is None:
+            net, _, length = key.partition('/')
+            length = int(length)
+            if ':' in net:
+                family, packed = 6, int.from_bytes(socket.inet_pton(socket.AF_INET6, net), 'big')
+            else:
+                family, packed = 4, int.from_bytes(socket.inet_pton(socket.AF_INET, net), 'big')
+            if not 0 <= length <= (128 if family == 6 else 32):
+                raise ValueError(f"invalid prefix length in {key}")
+            key_id = super().intern(key)
+            self.family.append(family)
+            self.net_hi.append(packed >> 64)
+            self.net_lo.append(packed & 0xffffffffffffffff)
+            self.length.append(length)
+        return key_id
+
+    def intern_many(self, keys, columns=None):
+        """ Interns a sequence of unique prefixes at once, returning their ids as an array
+            columns can hold the prefixes' already encoded family, net_hi, net_lo and length arrays, in which
+            case the new prefixes take their encoding from there instead of being parsed one by one"""
+        if columns is None:
+            return np.fromiter((self.intern(key) for key in keys), dtype=np.int64, count=len(keys))
+
+        start = len(self.keys)
+        key_ids = super().intern_many(keys)
+        # Keys are unique, so new ones were given consecutive ids in the order they appear
+        new = key_ids >= start
+        for column in ('family', 'net_hi', 'net_lo', 'length'):
+            values = getattr(self, column)
+            values.frombytes(np.frombuffer(columns[column], dtype=values.typecode)[new].tobytes())
+        return key_ids
+
+    def compact(self, keep):
+        dropped = super().compact(keep)
+        for column in ('family', 'net_hi', 'net_lo', 'length'):
+            values = getattr(self, column)
+            dropped += values.itemsize * int(np.count_nonzero(~keep))
+            setattr(self, column, array(values.typecode, np.frombuffer(values, dtype=values.typecode)[keep].tobytes()))
+        return dropped
+
+    def dump(self, arrays, name):
+        super().dump(arrays, name)
+        for column in ('family', 'net_hi', 'net_lo', 'length'):
+            arrays[f'{name}.{column}'] = np.frombuffer(getattr(self, column), dtype=getattr(self, column).typecode)
+
+    def load(self, arrays, name):
+        # The encoded columns are restored as-is so a warm start doesn't re-parse every prefix
+        super().load(arrays, name)
+        for column in ('family', 'net_hi', 'net_lo', 'length'):
+            getattr(self, column).frombytes(arrays[f'{name}.{column}'].tobytes())
+
+
+class BGPTable:
+    """ Aggregated snapshot of the BGP table
+        Origins per prefix, prefixes per ASN and per-family DFZ counts are tallied into typed arrays
+        indexed by interned id as each route is added, so no per-route objects are kept and the
+        checks never have to walk the table again"""
+
+    def __init__(self, prefixes=None, asns=None):
+        self.prefixes = prefixes if prefixes is not None else PrefixInterner()
+        self.asns = asns if asns is not None else Interner()
+        self.routes = 0
+        self.origins = array('I', bytes(4 * len(self.prefixes)))
+        self.prefix_counts = array('I', bytes(4 * len(self.asns)))
+        self.family_counts = {4: 0, 6: 0}
+
+    def __len__(self):
+        return self.routes
+
+    def add(self, pfx, asn):
+        pfx_id = self.prefixes.intern(pfx)
+        asn_id = self.asns.intern(asn)
+        origins = self.origins
+        prefix_counts = self.prefix_counts
+
+        if pfx_id >= len(origins):
+            origins.frombytes(bytes(4 * (pfx_id + 1 - len(origins))))
+        if asn_id >= len(prefix_counts):
+            prefix_counts.frombytes(bytes(4 * (asn_id + 1 - len(prefix_counts))))
+
+        # First route seen for this prefix adds it to its family's DFZ count
+        if not origins[pfx_id]:
+            self.family_counts[self.prefixes.family[pfx_id]] += 1
+        origins[pfx_id] += 1
+        prefix_counts[asn_id] += 1
+        self.routes += 1
+
+    def origins_per_prefix(self):
+        """ Number of origin ASNs per prefix id, zero for interned prefixes not in this table """
+        return _padded_counts(self.origins, len(self.prefixes))
+
+    def prefixes_per_asn(self):
+        """ Number of prefixes originated per ASN id, zero for interned ASNs not in this table """
+        return _padded_counts(self.prefix_counts, len(self.asns))
+
+    def dfz_counts(self):
+        """ Number of unique prefixes in this table per address family """
+        return {'v6': self.family_counts[6], 'v4': self.family_counts[4]}
+
+    def pack(self):
+        """ Compact picklable form of a table built with its own interning tables, for handing it back
+            from the parse worker without pickling a million separate strings"""
+        return {'routes': self.routes,
+                'family_counts': dict(self.family_counts),
+                'prefixes': '\n'.join(self.prefixes.keys).encode(),
+                'family': self.prefixes.family.tobytes(),
+                'net_hi': self.prefixes.net_hi.tobytes(),
+                'net_lo': self.prefixes.net_lo.tobytes(),
+                'length': self.prefixes.length.tobytes(),
+                'origins': self.origins.tobytes(),
+                'asns': self.asns.keys,
+                'prefix_counts': self.prefix_counts.tobytes()}
+
+    @classmethod
+    def unpack(cls, packed, prefixes, asns):
+        """ Rebuilds a packed table against long-lived interning tables, remapping its ids to theirs """
+        table = cls(prefixes, asns)
+        table.routes = packed['routes']
+        table.family_counts = packed['family_counts']
+
+        keys = packed['prefixes'].decode().split('\n') if packed['prefixes'] else []
+        pfx_ids = prefixes.intern_many(keys, packed)
+        origins = np.zeros(len(prefixes), dtype=np.uint32)
+        origins[pfx_ids] = np.frombuffer(packed['origins'], dtype=np.uint32)
+        table.origins = array('I', origins.tobytes())
+
+        asn_ids = asns.intern_many(packed['asns'])
+        prefix_counts = np.zeros(len(asns), dtype=np.uint32)
+        prefix_counts[asn_ids] = np.frombuffer(packed['prefix_counts'], dtype=np.uint32)
+        table.prefix_counts = array('I', prefix_counts.tobytes())
+
+        return table
+
+
+def _padded_counts(counts, length):
+    counts = np.frombuffer(counts, dtype=np.uint32).astype(np.int64)
+    if len(counts) < length:
+        counts = np.concatenate((counts, np.zeros(length - len(counts), dtype=np.int64)))
+    return counts
+
+
+class History:
+    """ Ring buffer of the last `width` samples for every interned key
+        Samples live in one (keys x width) array where each key has its own write position, and a running
+        sum per key is maintained on every push, so averages and threshold checks for all keys are a
+        handful of vectorized operations. Rows are added as the interning table grows"""
+
+    def __init__(self, keys=None, width=max_history, dtype=np.int32):
+        self.keys = keys if keys is not None else Interner()
+        self.width = width
+        self.samples = np.zeros((0, width), dtype=dtype)
+        self.head = np.zeros(0, dtype=np.int64)     # Next write position per key
+        self.count = np.zeros(0, dtype=np.int64)    # Number of samples held per key
+        self.sums = np.zeros(0, dtype=np.int64)     # Sum of the samples held per key
+        self.last_seen = np.zeros(0, dtype=np.int64)    # Cycle each key was last pushed in
+        self.changed_ids = np.zeros(0, dtype=np.int64)  # Keys the last push added or changed the newest sample of
+        self.held_ids = np.zeros(0, dtype=np.int64)     # Keys holding samples that the last push left out
+        self.evicted_keys = []                          # Keys the last eviction dropped
+        self.cycle = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def grow(self):
+        """ Adds empty rows for keys interned since the last call, doubling capacity as needed """
+        size = len(self.keys)
+        if size > len(self.samples):
+            capacity = max(size, 2 * len(self.samples))
+            extra = capacity - len(self.samples)
+            self.samples = np.concatenate((self.samples, np.zeros((extra, self.width), dtype=self.samples.dtype)))
+            self.head = np.concatenate((self.head, np.zeros(extra, dtype=np.int64)))
+            self.count = np.concatenate((self.count, np.zeros(extra, dtype=np.int64)))
+            self.sums = np.concatenate((self.sums, np.zeros(extra, dtype=np.int64)))
+            self.last_seen = np.concatenate((self.last_seen, np.zeros(extra, dtype=np.int64)))
+        self.size = max(self.size, size)
+
+    def push(self, ids, values, seen=None):
+        """ Records the latest sample for each key id, overwriting its oldest sample once the row is full
+            Only the ids in seen (all of ids by default) count as seen this cycle for eviction"""
+        self.grow()
+        ids = np.asarray(ids, dtype=np.int64)
+        values = np.asarray(values, dtype=np.int64)
+        head = self.head[ids]
+        previous = self.samples[ids, (head - 1) % self.width]
+        self.changed_ids = ids[(values != previous) | (self.count[ids] == 0)]
+        held = self.count[:self.size] > 0
+        held[ids] = False
+        self.held_ids = np.flatnonzero(held)
+        self.evicted_keys = []
+
+        # Unwritten slots are zero, so the sample being overwritten can always be subtracted
+        self.sums[ids] += values - self.samples[ids, head]
+        self.samples[ids, head] = values
+        self.head[ids] = (head + 1) % self.width
+        self.count[ids] = np.minimum(self.count[ids] + 1, self.width)
+        self.cycle += 1
+        self.last_seen[ids if seen is None else seen] = self.cycle
+
+    def evict(self, max_age):
+        """ Compacts out every key that hasn't been pushed for max_age cycles, renumbering the survivors
+            Returns the number of keys evicted and the bytes reclaimed"""
+        keep = (self.cycle - self.last_seen[:self.size]) < max_age
+        evicted = self.size - int(np.count_nonzero(keep))
+        if not evicted:
+            return 0, 0
+
+        before = self.nbytes()
+        self.evicted_keys = [self.keys.keys[i] for i in np.flatnonzero(~keep).tolist()]
+        reclaimed = self.keys.compact(keep)
+        self.samples = self.samples[:self.size][keep]
+        self.head = self.head[:self.size][keep]
+        self.count = self.count[:self.size][keep]
+        self.sums = self.sums[:self.size][keep]
+        self.last_seen = self.last_seen[:self.size][keep]
+        self.size = len(self.samples)
+
+        return evicted, reclaimed + before - self.nbytes()
+
+    def nbytes(self):
+        """ Bytes held by the sample and per-key arrays, including spare capacity """
+        return self.samples.nbytes + self.head.nbytes + self.count.nbytes + self.sums.nbytes + self.last_seen.nbytes
+
+    def active(self):
+        """ Ids of every key holding at least one sample """
+        return np.flatnonzero(self.count[:self.size])
+
+    def latest(self):
+        """ Most recent sample per key id """
+        return self.samples[np.arange(self.size), (self.head[:self.size] - 1) % self.width].astype(np.int64)
+
+    def average(self):
+        """ Average of the held samples per key id, zero for keys without samples """
+        count = self.count[:self.size]
+        return np.divide(self.sums[:self.size], count, out=np.zeros(self.size), where=count > 0)
+
+    def changes(self):
+        """ What the last push did, for applying it to a copy of to_dict(): the new newest sample of every key
+            it added or changed, and the keys it left out. Every other held key had its newest sample repeated,
+            and every key pushed keeps its newest width samples. Taken before any eviction renumbers the keys"""
+        keys = self.keys.keys
+        ids = self.changed_ids
+        latest = self.samples[ids, (self.head[ids] - 1) % self.width].tolist()
+        return {'width': self.width, 'latest': {keys[i]: value for i, value in zip(ids.tolist(), latest)},
+                'held': [keys[i] for i in self.held_ids.tolist()]}
+
+    def to_dict(self):
+        """ Samples per key, newest first, in the same shape the history dicts were published in """
+        ids = self.active()
+        order = (self.head[ids, None] - 1 - np.arange(self.width)) % self.width
+        rows = self.samples[ids[:, None], order].tolist()
+        keys = self.keys.keys
+        return {keys[i]: row[:count] for i, row, count in zip(ids.tolist(), rows, self.count[ids].tolist())}
+
+    def resize(self, width):
+        """ Changes the number of samples held per key, keeping the newest ones """
+        size = self.size
+        keep = min(width, self.width)
+        # Newest first, then reversed so the kept samples are laid out oldest first from slot zero
+        order = (self.head[:size, None] - 1 - np.arange(keep)) % self.width
+        kept = self.samples[np.arange(size)[:, None], order][:, ::-1]
+        count = np.minimum(self.count[:size], keep)
+        # Rows with fewer samples than kept have their unwritten slots at the start, shift them down
+        shift = (keep - count)[:, None]
+        kept = kept[np.arange(size)[:, None], (np.arange(keep) + shift) % keep]
+        kept[np.arange(keep) >= count[:, None]] = 0
+
+        self.samples = np.zeros((size, width), dtype=self.samples.dtype)
+        self.samples[:, :keep] = kept
+        self.head = count % width
+        self.count = count
+        self.sums = self.samples.sum(axis=1, dtype=np.int64)
+        self.last_seen = self.last_seen[:size]
+        self.width = width
+
+    def dump(self, arrays, name):
+        """ Adds this history and its keys to a dict of arrays for np.savez """
+        self.keys.dump(arrays, name)
+        # Positions and counts never exceed the width, and sums are cheap to rebuild on load
+        position_type = np.min_scalar_type(self.width)
+        arrays[name + '.samples'] = self.samples[:self.size]
+        arrays[name + '.head'] = self.head[:self.size].astype(position_type)
+        arrays[name + '.count'] = self.count[:self.size].astype(position_type)
+        arrays[name + '.age'] = self.cycle - self.last_seen[:self.size]
+
+    def load(self, arrays, name):
+        self.keys.load(arrays, name)
+        self.samples = arrays[name + '.samples'].astype(self.samples.dtype)
+        self.head = arrays[name + '.head'].astype(np.int64)
+        self.count = arrays[name + '.count'].astype(np.int64)
+        self.sums = self.samples.sum(axis=1, dtype=np.int64)
+        self.size = len(self.samples)
+        # Ages are stored relative to the checkpoint, schema 1 checkpoints predate eviction so all keys count as fresh
+        self.cycle = 0
+        self.last_seen = -arrays.get(name + '.age', np.zeros(self.size, dtype=np.int64))
+        width = self.samples.shape[1]
+        if width != self.width:
+            configured_width, self.width = self.width, width
+            self.resize(configured_width)
+
+
+def new_histories():
+    """ Empty history for every check that keeps one, each as wide as its source's history window """
+    return {'dfz': History(width=schedules['bgp']['history']),
+            'origins': History(PrefixInterner(), width=schedules['bgp']['history'], dtype=np.uint16),
+            'prefixes': History(width=schedules['bgp']['history']),
+            'invalid_roa': History(width=schedules['rpki']['history']),
+            'total_roa': History(width=schedules['rpki']['history'])}
+
+
+def save_history(path, histories):
+    """ Checkpoints every history to a single npz, written aside and renamed into place """
+    arrays = {'schema_version': np.array(history_schema_version)}
+    for name, history in histories.items():
+        history.dump(arrays, name)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as hf:
+        np.savez(hf, **arrays)
+    os.replace(tmp_path, path)
+
+
+def checkpoint_history(histories):
+    """ Saves the histories to the state directory, called with history_lock held by the stage that changed them """
+    try:
+        save_history(state_root + history_file, histories)
+    except OSError:
+        if debug:
+            print(f"failed to checkpoint history to {state_root + history_file}")
 
-def fetch_rpki_roa(url, headers):
-    results = requests.get(url, headers=headers).json()
 
-    invalid_roa = {}
-    total_roa = {}
+def load_history(path, histories):
+    """ Restores the histories checkpointed by save_history, leaving them empty if the checkpoint
+        is missing, unreadable or from a different schema version"""
+    try:
+        with np.load(path) as npz:
+            arrays = dict(npz)
+    except FileNotFoundError:
+        return False
+    except (OSError, ValueError, zipfile.BadZipFile):
+        if debug:
+            print(f"failed to read history checkpoint {path}")
+        return False
 
-    for repo in results.get('repositories'):
-        invalid = results['repositories'][repo].get('invalidROAs')
-        invalid_roa[repo] = invalid
+    schema_version = int(arrays.get('schema_version', -1))
+    if schema_version not in (1, history_schema_version):
+        if debug:
+            print(f"ignoring history checkpoint {path} with schema version {schema_version}")
+        return False
 
-        valid_roa = results['repositories'][repo].get('validROAs')
-        total_roa[repo] = int(valid_roa + invalid)
+    for name, history in histories.items():
+        try:
+            history.load(arrays, name)
+        except KeyError:
+            if debug:
+                print(f"history checkpoint {path} has no {name} history")
 
-    return invalid_roa, total_roa
+    return True
 
 
-def fetch_bgp_table(url, headers):
+def fetch_bgp_table(url, headers, prefixes=None, asns=None, last_digest=None):
     """ Fetches BGP/DFZ info as json from bgp.tools
-        Builds two dicts, keyed on ASN and Prefix"""
+        Builds a BGPTable, tallying the per-prefix, per-ASN and per-family counts as each line is parsed
+        The response is streamed and split into lines as raw bytes, so only one chunk of the
+        table is held in memory at a time rather than the whole payload
+        Returns the table and the sha256 of its body, or no table on a 304 for the last_digest body"""
 
-    results = requests.get(url, headers=headers)
+    results = CachedFetch('bgp', url, headers)
+    if results.not_modified and results.digest == last_digest:
+        results.close()
+        return None, last_digest
 
-    table_list = results.text.split('\n')
-    table_asn_key = {}
-    table_pfx_key = {}
+    table = BGPTable(prefixes, asns)
 
-    for x in table_list:
-        # Build a dict keyed on ASN
+    for line in results.iter_lines():
+        if not line:
+            continue
         try:
-            x = ujson.loads(x)
+            x = ujson.loads(line)
         except ujson.JSONDecodeError:
-            break
+            continue
+        asn = x.get('ASN')
+        pfx = x.get('CIDR')
+        if asn is None or not isinstance(pfx, str):
+            continue
         try:
-            asn = x.get('ASN')
-            if asn in table_asn_key:
-                table_asn_key[asn].append(x)
-            else:
-                table_asn_key[asn] = [x]
-        except KeyError:
-            break
+            table.add(pfx, asn)
+        except (ValueError, OSError):
+            if debug:
+                print(f"skipping malformed route {pfx} from AS{asn}")
 
-        # Build a dict keyed on prefix
-        try:
-            pfx = x.get('CIDR')
-            if pfx in table_pfx_key:
-                table_pfx_key[pfx].append(x)
-            else:
-                table_pfx_key[pfx] = [x]
-        except KeyError:
-            break
+    return table, results.digest
+
+
+def fetch_bgp_snapshot(url, headers, last_digest=None):
+    """ Fetches and parses the BGP table into a packed BGPTable, run in the parse worker process
+        Returns the packed table (None when unchanged since last_digest), its digest, the requests made
+        and the fetch's timings"""
 
-    return table_asn_key, table_pfx_key
+    http_log['bgp'] = []
+    timings = {}
+    table, digest = timed(timings, 'fetch_bgp_table', fetch_bgp_table, url, headers, last_digest=last_digest)
+    timings['fetch_bgp_table'].update({'bytes': fetched_bytes('bgp'), 'records': table.routes if table else 0})
+    packed = timed(timings, 'pack', table.pack) if table is not None else None
 
+    return packed, digest, http_log['bgp'], timings
 
-def check_bgp_origins(table_pfx_key, num_origins_history):
+
+def check_bgp_origins(table, num_origins_history):
     """ Store the latest num of origin AS per prefix
         Check the history to see if any prefixes have an increased number of origin AS"""
 
     fucked_reasons = []
 
-    for pfx in table_pfx_key:
-        num_origins = len(table_pfx_key.get(pfx))
-        if pfx in num_origins_history:
-            num_origins_history[pfx].insert(0, num_origins)
-            if len(num_origins_history.get(pfx)) > max_history:
-                zz = num_origins_history[pfx].pop()
-        else:
-            num_origins_history[pfx] = [num_origins]
+    # The table shares the history's interning table, so every prefix in the history has a slot in
+    # origins_per_prefix and the ones missing from this snapshot are already zero there. Pushing the
+    # whole id range records a withdrawal as a zero sample rather than leaving a stale count behind
+    origins_per_prefix = table.origins_per_prefix()
+    num_origins_history.push(np.arange(len(origins_per_prefix)), origins_per_prefix,
+                             seen=np.flatnonzero(origins_per_prefix))
 
-    # Check for an increase in origins, could signify hijacking
-    for pfx, origins in num_origins_history.items():
-        avg = sum(origins) / len(origins)
+    latest = num_origins_history.latest()
+    avg = num_origins_history.average()
+    pfx_keys = num_origins_history.keys.keys
 
-        # Exclude any multi-origin anycast prefixes
-        if origins[0] > avg and avg < 2:
-            reason = f"{pfx} is being originated by {origins[0]} ASNs, this is above the " \
-                     f"{((max_history * update_frequency) / 60 ) / 60}hrs average of {math.floor(avg)}"
-            fucked_reasons.append(reason)
-            if debug:
-                print(reason)
+    # Check for an increase in origins, could signify hijacking
+    # Exclude any multi-origin anycast prefixes, and prefixes coming back with a single origin after a withdrawal
+    for i in np.flatnonzero((latest > avg) & (avg < 2) & (latest > 1)):
+        reason = f"{pfx_keys[i]} is being originated by {latest[i]} ASNs, this is above the " \
+                 f"{history_hours('bgp')}hrs average of {math.floor(avg[i])}"
+        fucked_reasons.append(reason)
+        if debug:
+            print(reason)
 
-        # Catch a sudden decrease in origins of anycast prefixes that usually have a lot
-        if origins[0] < 2 and avg > 5:
-            reason = f"{pfx} is being originated by {origins[0]} ASNs, this is below the " \
-                     f"{((max_history * update_frequency) / 60 ) / 60}hrs average of {math.floor(avg)}"
-            fucked_reasons.append(reason)
-            if debug:
-                print(reason)
+    # Catch a sudden decrease in origins of anycast prefixes that usually have a lot
+    for i in np.flatnonzero((latest < 2) & (avg > 5)):
+        reason = f"{pfx_keys[i]} is being originated by {latest[i]} ASNs, this is below the " \
+                 f"{history_hours('bgp')}hrs average of {math.floor(avg[i])}"
+        fucked_reasons.append(reason)
+        if debug:
+            print(reason)
 
     return num_origins_history, fucked_reasons
 
 
-def check_bgp_prefixes(table_asn_key, num_prefixes_history):
+def check_bgp_prefixes(table, num_prefixes_history):
     """ Store the latest number of prefixes advertised per ASN
         Check the history to see if any ASNs have a drastically reduced number of prefixes"""
 
     fucked_reasons = []
 
-    # Add latest result to the history
-    for asn in table_asn_key:
-        num_prefixes = len(table_asn_key.get(asn))
-        if asn in num_prefixes_history:
-            num_prefixes_history[asn].insert(0, num_prefixes)
-            if len(num_prefixes_history.get(asn)) > max_history:
-                zz = num_prefixes_history[asn].pop()
-        else:
-            num_prefixes_history[asn] = [num_prefixes]
+    # Add latest result to the history, ASNs missing from this snapshot are recorded as originating nothing
+    prefixes_per_asn = table.prefixes_per_asn()
+    num_prefixes_history.push(np.arange(len(prefixes_per_asn)), prefixes_per_asn,
+                              seen=np.flatnonzero(prefixes_per_asn))
 
     # Check for a drastic decrease in prefixes being advertised by an ASN
-    for asn, prefixes in num_prefixes_history.items():
-        avg = sum(prefixes) / len(prefixes)
-        percentage = 100 - int(round((prefixes[0] / avg) * 100, 0))
-        if percentage > bgp_prefix_threshold:
-            reason = f"AS{asn} is originating only {prefixes[0]} prefixes, {percentage}% " \
-                     f"fewer than their {((max_history * update_frequency) / 60 ) / 60}hrs average of {math.ceil(avg)}"
-            fucked_reasons.append(reason)
-            if debug:
-                print(reason)
+    ids = num_prefixes_history.active()
+    latest = num_prefixes_history.latest()[ids]
+    avg = num_prefixes_history.average()[ids]
+    # ASNs that have been gone for the whole window average zero and have nothing left to compare
+    percentage = 100 - np.round(np.divide(latest, avg, out=np.ones(len(ids)), where=avg > 0) * 100, 0).astype(np.int64)
+    asn_keys = num_prefixes_history.keys.keys
+
+    for i in np.flatnonzero(percentage > bgp_prefix_threshold):
+        reason = f"AS{asn_keys[ids[i]]} is originating only {latest[i]} prefixes, {percentage[i]}% " \
+                 f"fewer than their {history_hours('bgp')}hrs average of {math.ceil(avg[i])}"
+        fucked_reasons.append(reason)
+        if debug:
+            print(reason)
 
     return num_prefixes_history, fucked_reasons
 
@@ -247,25 +1015,20 @@ def check_rpki_totals(total_roa, rpki_total_roa_history):
 
     fucked_reasons = []
 
-    for repo in total_roa:
-        if repo in rpki_total_roa_history:
-            rpki_total_roa_history[repo].insert(0, total_roa.get(repo))
-            if len(rpki_total_roa_history) > max_history:
-                zz = rpki_total_roa_history[repo].pop()
-        else:
-            rpki_total_roa_history[repo] = [total_roa.get(repo)]
+    repos = rpki_total_roa_history.keys
+    rpki_total_roa_history.push([repos.intern(repo) for repo in total_roa], list(total_roa.values()))
 
-    for repo, totals in rpki_total_roa_history.items():
-        avg = int(sum(totals) / len(totals))
-        try:
-            percentage = (totals[0] / avg) * 100
-        except ZeroDivisionError:
-            percentage = 100
-        if (100 - percentage) > total_roa_threshold:
-            reason = f"{repo} has decreased published ROAs by {percentage}, from an average of {avg} to {totals[0]}"
-            fucked_reasons.append(reason)
-            if debug:
-                print(reason)
+    ids = rpki_total_roa_history.active()
+    latest = rpki_total_roa_history.latest()[ids]
+    avg = rpki_total_roa_history.average()[ids].astype(np.int64)
+    percentage = np.divide(latest, avg, out=np.ones(len(ids)), where=avg != 0) * 100
+
+    for i in np.flatnonzero((100 - percentage) > total_roa_threshold):
+        reason = f"{repos.keys[ids[i]]} has decreased published ROAs by {percentage[i]}, " \
+                 f"from an average of {avg[i]} to {latest[i]}"
+        fucked_reasons.append(reason)
+        if debug:
+            print(reason)
 
     return rpki_total_roa_history, fucked_reasons
 
@@ -276,60 +1039,47 @@ def check_rpki_invalids(invalid_roa, rpki_invalids_history):
 
     fucked_reasons = []
 
-    for repo in invalid_roa:
-        if repo in rpki_invalids_history:
-            rpki_invalids_history[repo].insert(0, invalid_roa.get(repo))
-            if len(rpki_invalids_history) > max_history:
-                zz = rpki_invalids_history[repo].pop()
-        else:
-            rpki_invalids_history[repo] = [invalid_roa.get(repo)]
+    repos = rpki_invalids_history.keys
+    rpki_invalids_history.push([repos.intern(repo) for repo in invalid_roa], list(invalid_roa.values()))
 
-    for repo, invalids in rpki_invalids_history.items():
-        avg = sum(invalids) / len(invalids)
-        if invalids[0] > avg:
-            reason = f"{invalids[0]} RPKI ROAs from {repo} have invalid routes being advertised to the DFZ, " \
-                            f"which is more than the {((max_history * update_frequency) / 60 ) / 60}hrs average of {math.floor(avg)}"
-            fucked_reasons.append(reason)
-            if debug:
-                print(reason)
+    ids = rpki_invalids_history.active()
+    latest = rpki_invalids_history.latest()[ids]
+    avg = rpki_invalids_history.average()[ids]
+
+    for i in np.flatnonzero(latest > avg):
+        reason = f"{latest[i]} RPKI ROAs from {repos.keys[ids[i]]} have invalid routes being advertised to the DFZ, " \
+                        f"which is more than the {history_hours('rpki')}hrs average of {math.floor(avg[i])}"
+        fucked_reasons.append(reason)
+        if debug:
+            print(reason)
 
     return rpki_invalids_history, fucked_reasons
 
 
-def check_dfz(table_pfx_key, num_dfz_routes_history):
+def check_dfz(table, num_dfz_routes_history):
     """ Keep track of the number of routes present in both the IPv4 and IPv6 DFZ
         Alert when DFZ size increases by dfz_threshold %
-        Iterating this dict to parse v4 or v6 seems silly, but oh well.
     """
 
     fucked_reasons = []
 
-    v6_dfz_count = 0
-    v4_dfz_count = 0
-
-    for pfx in table_pfx_key:
-        if pfx.find('::/') > 0:
-            v6_dfz_count += 1
-        else:
-            v4_dfz_count += 1
-
-    num_dfz_routes_history['v6'].insert(0, v6_dfz_count)
-    if len(num_dfz_routes_history['v6']) > max_history:
-        num_dfz_routes_history['v6'].pop()
+    dfz_counts = table.dfz_counts()
+    families = num_dfz_routes_history.keys
+    num_dfz_routes_history.push([families.intern('v6'), families.intern('v4')], [dfz_counts['v6'], dfz_counts['v4']])
 
-    num_dfz_routes_history['v4'].insert(0, v4_dfz_count)
-    if len(num_dfz_routes_history['v4']) > max_history:
-        num_dfz_routes_history['v4'].pop()
+    latest = num_dfz_routes_history.latest()
+    avg = num_dfz_routes_history.average()
 
-    avg_v6 = sum(num_dfz_routes_history['v6']) / len(num_dfz_routes_history['v6'])
-    v6_pc = round(((num_dfz_routes_history['v6'][0] / avg_v6) * 100), 1)
+    v6 = families.ids['v6']
+    avg_v6 = avg[v6]
+    v6_pc = round(((latest[v6] / avg_v6) * 100), 1)
 
     if v6_pc - 100 > dfz_threshold:
-        reason = f"The IPv6 DFZ has increased by {v6_pc}% from the {((max_history * update_frequency) / 60 ) / 60}hrs " \
-                 f"average {int(avg_v6)} to {num_dfz_routes_history['v6'][0]} routes"
+        reason = f"The IPv6 DFZ has increased by {v6_pc}% from the {history_hours('bgp')}hrs " \
+                 f"average {int(avg_v6)} to {latest[v6]} routes"
     elif 100 - v6_pc > dfz_threshold:
-        reason = f"The IPv6 DFZ has decreased by {v6_pc}% from the {((max_history * update_frequency) / 60) / 60}hrs " \
-                 f"average {int(avg_v6)} to {num_dfz_routes_history['v6'][0]} routes"
+        reason = f"The IPv6 DFZ has decreased by {v6_pc}% from the {history_hours('bgp')}hrs " \
+                 f"average {int(avg_v6)} to {latest[v6]} routes"
     else:
         reason = None
 
@@ -339,15 +1089,16 @@ def check_dfz(table_pfx_key, num_dfz_routes_history):
             print(reason)
         del reason
 
-    avg_v4 = sum(num_dfz_routes_history['v4']) / len(num_dfz_routes_history['v4'])
-    v4_pc = round(((num_dfz_routes_history['v4'][0] / avg_v4) * 100), 1)
+    v4 = families.ids['v4']
+    avg_v4 = avg[v4]
+    v4_pc = round(((latest[v4] / avg_v4) * 100), 1)
 
     if v4_pc - 100 > dfz_threshold:
-        reason = f"The IPv4 DFZ has increased by {v4_pc - 100}% from the {((max_history * update_frequency) / 60 ) / 60}hrs " \
-                 f"average {int(avg_v4)} to {num_dfz_routes_history['v4'][0]} routes"
+        reason = f"The IPv4 DFZ has increased by {v4_pc - 100}% from the {history_hours('bgp')}hrs " \
+                 f"average {int(avg_v4)} to {latest[v4]} routes"
     elif 100 - v4_pc > dfz_threshold:
-        reason = f"The IPv4 DFZ has decreased by {v4_pc}% from the {((max_history * update_frequency) / 60) / 60}hrs " \
-                 f"average {int(avg_v4)} to {num_dfz_routes_history['v4'][0]} routes"
+        reason = f"The IPv4 DFZ has decreased by {v4_pc}% from the {history_hours('bgp')}hrs " \
+                 f"average {int(avg_v4)} to {latest[v4]} routes"
     else:
         reason = None
 
@@ -359,6 +1110,18 @@ def check_dfz(table_pfx_key, num_dfz_routes_history):
     return num_dfz_routes_history, fucked_reasons
 
 
+def evict_stale(name, history, source):
+    """ Drops keys unseen for evict_after seconds' worth of the source's cycles from a history and reports
+        what was reclaimed. Cycles whose input hadn't changed push nothing, so keys can outlive it, never fall short"""
+
+    max_age = math.ceil(evict_after / schedules[source]['interval'])
+    evicted, reclaimed = history.evict(max_age)
+    if evicted and debug:
+        print(f"Evicted {evicted} {name} keys unseen for {max_age} cycles, reclaiming {reclaimed} bytes")
+
+    return {'evicted': evicted, 'bytes': reclaimed}
+
+
 def check_dns_roots(v6_roots_failed, v4_roots_failed):
     fucked_reasons = []
 
@@ -406,125 +1169,896 @@ def check_ripe_atlas_status(probe_status):
     return fucked_reasons
 
 
-def main():
+def run_bgp_stage(headers, state):
+    """ Fetches the BGP table, in the parse worker when there is one, and runs the origin, prefix and DFZ checks """
 
-    headers = {'User-Agent': 'howfuckedistheinternet.com'}
+    histories = state['histories']
+    input_digests = state['input_digests']
+    stage = {'reasons': {}, 'results': {}, 'evictions': {}}
 
-    results = {}
-
-    num_dfz_routes_history = {'v6': [], 'v4': []}
-    num_origins_history = {}
-    num_prefixes_history = {}
-    rpki_invalid_roa_history = {}
-    rpki_total_roa_history = {}
-
-    while True:
-        # Reset reasons and duration timer
-        fucked_reasons = {'origins': [], 'prefixes': [], 'dns_root': [], 'atlas_connected': [],
-                          'invalid_roa': [], 'total_roa': [], 'dfz': []}
-
-        before = datetime.now()
-
-        if bgp_enabled:
-            table_asn_key, table_pfx_key = fetch_bgp_table(bgp_table_url, headers)
-            num_origins_history, fucked_reasons['origins'] = check_bgp_origins(table_pfx_key, num_origins_history)
-            num_prefixes_history, fucked_reasons['prefixes'] = check_bgp_prefixes(table_asn_key, num_prefixes_history)
-            num_dfz_routes_history, fucked_reasons['dfz'] = check_dfz(table_pfx_key, num_dfz_routes_history)
-
-            results['bgp'] = {'origins': num_origins_history, 'prefixes': num_prefixes_history}
-            del table_asn_key, table_pfx_key
-
-        if rpki_enabled:
-            invalid_roa, total_roa = fetch_rpki_roa(routinator_api_url, headers)
-            rpki_invalid_roa_history, fucked_reasons['invalid_roa'] = check_rpki_invalids(invalid_roa, rpki_invalid_roa_history)
-            rpki_total_roa_history, fucked_reasons['total_roa'] = check_rpki_totals(total_roa, rpki_total_roa_history)
-
-            results['rpki'] = {'invalid_roa': rpki_invalid_roa_history, 'total_roa': rpki_total_roa_history}
-            del invalid_roa, total_roa
-
-        if atlas_enabled:
-            v6_roots_failed, v4_roots_failed = fetch_root_dns(ripe_atlas_api_url, headers)
-            fucked_reasons['dns_root'] = check_dns_roots(v6_roots_failed, v4_roots_failed)
-
-            probe_status = fetch_ripe_atlas_status(ripe_atlas_api_url, headers)
-            fucked_reasons['atlas_connected'] = check_ripe_atlas_status(probe_status)
-
-            results['atlas'] = {'dns_roots': {'v6': v6_roots_failed, 'v4': v4_roots_failed}}
-            del v6_roots_failed, v4_roots_failed, probe_status
-
-        weighted_reasons = 0
-        for metric, reasons in fucked_reasons.items():
-            weighted_reasons = weighted_reasons + (len(reasons) * weighting.get(metric))
-        unweighted_reasons = sum(map(lambda x: len(x), fucked_reasons.values()))
-
-        if weighted_reasons > 200:
-            status = "The Internet is totally, utterly, and completely fucked"
-        elif weighted_reasons > 100:
-            status = "The Internet is completely fucked"
-        elif weighted_reasons > 60:
-            status = "The Internet is utterly fucked"
-        elif weighted_reasons > 50:
-            status = "The Internet is totally fucked"
-        elif weighted_reasons > 40:
-            status = "The Internet is really fucked"
-        elif weighted_reasons > 30:
-            status = "The Internet is rather fucked"
-        elif weighted_reasons > 20:
-            status = "The Internet is quite fucked"
-        elif weighted_reasons > 15:
-            status = "The Internet is pretty fucked"
-        elif weighted_reasons > 10:
-            status = "The Internet is somewhat fucked"
-        elif weighted_reasons > 5:
-            status = "The Internet is partially fucked"
-        elif weighted_reasons > 0:
-            status = "The Internet is just a bit fucked"
-        else:
-            status = "The Internet is fucked no more than usual"
-
-        results['status'] = status
-
-        if write_enabled:
-            with open(root + status_file, 'w') as sf:
-                sf.write(status + '\n')
-
-        if write_enabled:
-            with open(root + why_file, 'w') as wf:
-                for metric, reasons in fucked_reasons.items():
-                    if reasons:
-                        wf.writelines(f"<h4>{metric}:</h4>\n")
-                        print('<ul class="why-list">')
-                        for reason in sorted(reasons):
-                            wf.writelines(f"<li><var>{reason}</var>\n")
-                        wf.writelines("</ul>")
-                    else:
-                        wf.write('')
+    fetched = None
+    if state['bgp_pool']:
+        try:
+            fetched = state['bgp_pool'].submit(fetch_bgp_snapshot, bgp_table_url, headers, input_digests.get('bgp'))
+            packed, digest, http_log['bgp'], stage['timings'] = fetched.result()
+        except BrokenProcessPool:
+            # The worker was killed (OOM, segfault) and can't safely be forked again from this threaded process,
+            # so the table is parsed in process from now on
+            if debug:
+                print("BGP parse worker died, parsing in process from now on")
+            state['bgp_pool'].shutdown(wait=False)
+            state['bgp_pool'] = fetched = None
+    if fetched is None:
+        packed, digest, _, stage['timings'] = fetch_bgp_snapshot(bgp_table_url, headers, input_digests.get('bgp'))
+    timings = stage['timings']
+
+    # A table byte-identical to the last one checked has the same reasons, and pushing it
+    # into the history again would only count the same snapshot twice
+    if digest is not None and digest == input_digests.get('bgp'):
+        for metric in ('origins', 'prefixes', 'dfz'):
+            stage['reasons'][metric] = state['last_reasons'][metric]
+    # An empty table is a failed fetch, not every prefix on the Internet being withdrawn at once
+    elif packed and packed['routes']:
+        with history_lock:
+            table = timed(timings, 'unpack', BGPTable.unpack, packed, histories['origins'].keys,
+                          histories['prefixes'].keys)
+            del packed
+            stage['gauges'] = {'dfz_routes': table.dfz_counts()}
+            for metric, check in (('origins', check_bgp_origins), ('prefixes', check_bgp_prefixes), ('dfz', check_dfz)):
+                _, stage['reasons'][metric] = timed(timings, check.__name__, check, table, histories[metric])
+                timings[check.__name__].update({'keys': len(histories[metric]),
+                                                'reasons': len(stage['reasons'][metric])})
+            stage['changes'] = {metric: histories[metric].changes() for metric in ('origins', 'prefixes', 'dfz')}
+            for metric in ('origins', 'prefixes'):
+                stage['evictions'][metric] = timed(timings, f'evict_{metric}', evict_stale, metric, histories[metric],
+                                                   'bgp')
+            for metric, changes in stage['changes'].items():
+                changes['evicted'] = histories[metric].evicted_keys
+            del table
+            if persist_enabled:
+                timed(timings, 'checkpoint', checkpoint_history, histories)
+        input_digests['bgp'] = digest
+        # Rebuilding the per-prefix and per-ASN documents is seconds of CPU, so it's only done when they changed
+        stage['results']['bgp'] = timed(timings, 'to_dict', lambda: {'origins': histories['origins'].to_dict(),
+                                                                     'prefixes': histories['prefixes'].to_dict()})
+    elif debug:
+        print(f"no routes fetched from {bgp_table_url}, skipping BGP checks")
+
+    return stage
+
+
+def run_rpki_stage(headers, state):
+    """ Fetches the Routinator status and runs the invalid and total ROA checks """
+
+    histories = state['histories']
+    input_digests = state['input_digests']
+    stage = {'reasons': {}, 'results': {}, 'evictions': {}, 'timings': {}}
+    timings = stage['timings']
+    http_log['rpki'] = []
+
+    invalid_roa, total_roa, digest = timed(timings, 'fetch_rpki_roa', fetch_rpki_roa, routinator_api_url, headers)
+    timings['fetch_rpki_roa'].update({'bytes': fetched_bytes('rpki'), 'records': len(total_roa)})
+    if digest is not None and digest == input_digests.get('rpki'):
+        for metric in ('invalid_roa', 'total_roa'):
+            stage['reasons'][metric] = state['last_reasons'][metric]
+    else:
+        with history_lock:
+            for metric, check, roa in (('invalid_roa', check_rpki_invalids, invalid_roa),
+                                       ('total_roa', check_rpki_totals, total_roa)):
+                _, stage['reasons'][metric] = timed(timings, check.__name__, check, roa, histories[metric])
+                timings[check.__name__].update({'keys': len(roa), 'reasons': len(stage['reasons'][metric])})
+            stage['changes'] = {metric: histories[metric].changes() for metric in ('invalid_roa', 'total_roa')}
+            stage['evictions']['invalid_roa'] = evict_stale('invalid_roa', histories['invalid_roa'], 'rpki')
+            stage['evictions']['total_roa'] = evict_stale('total_roa', histories['total_roa'], 'rpki')
+            for metric, changes in stage['changes'].items():
+                changes['evicted'] = histories[metric].evicted_keys
+            if persist_enabled:
+                timed(timings, 'checkpoint', checkpoint_history, histories)
+        input_digests['rpki'] = digest
+        stage['results']['rpki'] = {'invalid_roa': histories['invalid_roa'].to_dict(),
+                                    'total_roa': histories['total_roa'].to_dict()}
+
+    return stage
+
+
+def run_atlas_roots_stage(headers, state):
+    """ Fetches the RIPE Atlas root server measurements and runs the DNS root check """
+
+    input_digests = state['input_digests']
+    stage = {'reasons': {}, 'results': {}, 'evictions': {}, 'timings': {}}
+    timings = stage['timings']
+    http_log['atlas_roots'] = []
+
+    # The measurements are fetched on a pool of threads, so this CPU time only covers collecting them
+    v6_roots_failed, v4_roots_failed, digest = timed(timings, 'fetch_root_dns', fetch_root_dns, ripe_atlas_api_url,
+                                                     headers)
+    roots = list(v6_roots_failed.values()) + list(v4_roots_failed.values())
+    stage['gauges'] = {'root_failures': {(server, family): round(len(root['failed']) / root['total'] * 100, 1)
+                                         for family, roots_failed in (('v6', v6_roots_failed), ('v4', v4_roots_failed))
+                                         for server, root in roots_failed.items() if root['total']}}
+    timings['fetch_root_dns'].update({'bytes': fetched_bytes('atlas_roots'),
+                                      'records': sum(root['total'] for root in roots)})
+    if digest is not None and digest == input_digests.get('dns_root'):
+        stage['reasons']['dns_root'] = state['last_reasons']['dns_root']
+    else:
+        stage['reasons']['dns_root'] = timed(timings, 'check_dns_roots', check_dns_roots, v6_roots_failed,
+                                             v4_roots_failed)
+        timings['check_dns_roots'].update({'keys': len(roots), 'reasons': len(stage['reasons']['dns_root'])})
+        input_digests['dns_root'] = digest
+
+    stage['results']['atlas'] = {'dns_roots': {'v6': v6_roots_failed, 'v4': v4_roots_failed}}
 
-        after = datetime.now()
-        duration = after - before
+    return stage
+
+
+def run_atlas_probes_stage(headers, state):
+    """ Fetches the RIPE Atlas probe connection status and runs the disconnected probe check """
+
+    input_digests = state['input_digests']
+    stage = {'reasons': {}, 'results': {}, 'evictions': {}, 'timings': {}}
+    timings = stage['timings']
+    http_log['atlas_probes'] = []
+
+    probe_status, digest = timed(timings, 'fetch_ripe_atlas_status', fetch_ripe_atlas_status, ripe_atlas_api_url,
+                                 headers)
+    probes = len(probe_status['connected']) + len(probe_status['disconnected'])
+    timings['fetch_ripe_atlas_status'].update({'bytes': fetched_bytes('atlas_probes'), 'records': probes})
+    if digest is not None and digest == input_digests.get('atlas_connected'):
+        stage['reasons']['atlas_connected'] = state['last_reasons']['atlas_connected']
+    else:
+        stage['reasons']['atlas_connected'] = timed(timings, 'check_ripe_atlas_status', check_ripe_atlas_status,
+                                                    probe_status)
+        timings['check_ripe_atlas_status'].update({'keys': probes,
+                                                   'reasons': len(stage['reasons']['atlas_connected'])})
+        input_digests['atlas_connected'] = digest
+
+    return stage
+
+
+def fuckedness_status(weighted_reasons):
+    """ Places a weighted reason count on the scale of fuckedness """
+
+    if weighted_reasons > 200:
+        status = "The Internet is totally, utterly, and completely fucked"
+    elif weighted_reasons > 100:
+        status = "The Internet is completely fucked"
+    elif weighted_reasons > 60:
+        status = "The Internet is utterly fucked"
+    elif weighted_reasons > 50:
+        status = "The Internet is totally fucked"
+    elif weighted_reasons > 40:
+        status = "The Internet is really fucked"
+    elif weighted_reasons > 30:
+        status = "The Internet is rather fucked"
+    elif weighted_reasons > 20:
+        status = "The Internet is quite fucked"
+    elif weighted_reasons > 15:
+        status = "The Internet is pretty fucked"
+    elif weighted_reasons > 10:
+        status = "The Internet is somewhat fucked"
+    elif weighted_reasons > 5:
+        status = "The Internet is partially fucked"
+    elif weighted_reasons > 0:
+        status = "The Internet is just a bit fucked"
+    else:
+        status = "The Internet is fucked no more than usual"
+
+    return status
+
+
+class Scoreboard:
+    """ The latest reasons for every metric, when each was last updated, and the score they add up to
+        Each metric's weighted contribution is kept, so updating one metric re-scores by summing a
+        handful of numbers instead of recounting every metric's reasons"""
+
+    def __init__(self, metrics):
+        self.reasons = {metric: [] for metric in metrics}
+        self.updated = {metric: None for metric in metrics}
+        self.refreshed = {metric: None for metric in metrics}
+        self.stale = set()
+        self.weighted = {metric: 0 for metric in metrics}
+        self.counts = {metric: 0 for metric in metrics}
+        self.weighted_reasons = 0
+        self.unweighted_reasons = 0
+        self.status = fuckedness_status(0)
+        self.added = {}
+        self.resolved = {}
+
+    def update(self, metric, reasons):
+        """ Replaces a metric's reasons and re-scores, returning whether its reasons or staleness changed """
+        self.refreshed[metric] = time.time()
+        self.updated[metric] = datetime.fromtimestamp(self.refreshed[metric], timezone.utc).isoformat(timespec="seconds")
+        was_stale = metric in self.stale
+        self.stale.discard(metric)
+        if reasons == self.reasons[metric]:
+            return was_stale
+
+        added = set(reasons).difference(self.reasons[metric])
+        resolved = set(self.reasons[metric]).difference(reasons)
+        if added:
+            self.added[metric] = sorted(added.union(self.added.get(metric, [])))
+        if resolved:
+            self.resolved[metric] = sorted(resolved.union(self.resolved.get(metric, [])))
+        self.reasons[metric] = reasons
+        self.weighted[metric] = len(reasons) * weighting.get(metric)
+        self.counts[metric] = len(reasons)
+        # Summed afresh rather than adjusted by the difference, so float weights can't drift
+        self.weighted_reasons = sum(self.weighted.values())
+        self.unweighted_reasons = sum(self.counts.values())
+        self.status = fuckedness_status(self.weighted_reasons)
+        return True
+
+    def take_changes(self):
+        """ Reasons added and resolved per metric since the last call """
+        added, resolved = self.added, self.resolved
+        self.added, self.resolved = {}, {}
+        return added, resolved
+
+    def mark_stale(self, metrics):
+        """ Keeps counting metrics' last reasons, but flags them as no longer current """
+        self.stale.update(metrics)
+
+    def staleness(self):
+        """ Seconds since each stale metric was last updated, None if it never has been """
+        now = time.time()
+        return {metric: round(now - self.refreshed[metric]) if self.refreshed[metric] else None
+                for metric in self.stale}
+
+
+def record_stage(source, when):
+    """ Archives the body of every upstream response a source's stage just fetched, taken from the HTTP cache
+        they were written through to, as one compressed recording per run named for when it started """
+
+    os.makedirs(state_root + recordings_dir, exist_ok=True)
+    path = state_root + recordings_dir + time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(when)) + f'-{source}.zip'
+
+    manifest = {}
+    with zipfile.ZipFile(path + '.tmp', 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        for entry in http_log.get(source, []):
+            if entry['status'] not in (200, 304) or upstream_name(entry['url']) in manifest:
+                continue
+            try:
+                zf.write(state_root + http_cache_dir + url_key(entry['url']) + '.body', url_key(entry['url']))
+            except OSError:
+                if debug:
+                    print(f"no cached body for {entry['url']} to record")
+                continue
+            manifest[upstream_name(entry['url'])] = url_key(entry['url'])
+        zf.writestr(recording_manifest, ujson.dumps(manifest))
+    os.replace(path + '.tmp', path)
+
+
+def replay_recordings(path):
+    """ The recordings in a directory as (source, path) in the order they were recorded """
+    names = sorted(name for name in os.listdir(path) if name.endswith('.zip'))
+    return [(name[:-4].split('-', 1)[1], os.path.join(path, name)) for name in names]
+
+
+def digested(content):
+    """ (sha1, content) of a rendered file, the form every file is handed around in until it's written """
+    return hashlib.sha1(content.encode()).hexdigest(), content
+
+
+def shard_results(results):
+    """ Splits a stage's results into detail documents, {path under results_dir: (sha1, encoded document)}
+        Each history gets its own document, and the per-prefix and per-ASN ones are spread over results_shards
+        documents by the crc32 of the key, so a reader after one key only needs the one document holding it"""
+
+    documents = {}
+    for section, details in results.items():
+        for name, detail in details.items():
+            if name in sharded_results:
+                shards = [{} for _ in range(results_shards)]
+                for key, samples in detail.items():
+                    shards[zlib.crc32(str(key).encode()) % results_shards][key] = samples
+                for shard, contents in enumerate(shards):
+                    documents[f"{section}/{name}/{shard:02x}.json"] = ujson.dumps(contents)
+            else:
+                documents[f"{section}/{name}.json"] = ujson.dumps(detail)
+
+    return {path: digested(body) for path, body in documents.items()}
+
+
+def run_stage(source, run, headers, state):
+    """ Runs a source's stage and encodes its results into detail documents while still on the stage's thread,
+        so publishing only has to write out the ones that changed"""
+
+    when = time.time()
+    wall, cpu = time.perf_counter(), time.thread_time()
+    stage = run(headers, state)
+    if record_enabled:
+        record_stage(source, when)
+    stage['documents'] = timed(stage['timings'], 'encode', shard_results, stage['results'])
+    del stage['results']
+    stage['timings']['stage'] = {'wall': round(time.perf_counter() - wall, 6), 'cpu': round(time.thread_time() - cpu, 6),
+                                 'bytes': fetched_bytes(source)}
+
+    return stage
+
+
+def label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_metrics(scoreboard, schedule, timings, gauges, histories, writer_stats):
+    """ Renders the latest publish in the Prometheus text exposition format """
+
+    families = []
+
+    def family(name, kind, help_text, samples):
+        lines = [f"# HELP fuckedness_{name} {help_text}", f"# TYPE fuckedness_{name} {kind}"]
+        for labels, value in samples:
+            if value is None:
+                continue
+            label_text = ','.join(f'{key}="{label_value(val)}"' for key, val in labels.items())
+            lines.append(f"fuckedness_{name}{{{label_text}}} {value}" if labels else f"fuckedness_{name} {value}")
+        families.append('\n'.join(lines))
+
+    family('status_info', 'gauge', 'The current status', [({'status': scoreboard.status}, 1)])
+    family('weighted_reasons', 'gauge', 'Reasons weighted by metric, the score the status is placed on',
+           [({}, scoreboard.weighted_reasons)])
+    family('unweighted_reasons', 'gauge', 'Reasons across every metric', [({}, scoreboard.unweighted_reasons)])
+    family('reasons', 'gauge', 'Reasons per metric', [({'metric': metric}, count)
+                                                       for metric, count in scoreboard.counts.items()])
+    family('metric_stale_seconds', 'gauge', 'Age of the reasons of metrics whose source is overdue or failing',
+           [({'metric': metric}, age) for metric, age in scoreboard.staleness().items()])
+
+    dfz_routes = gauges.get('bgp', {}).get('dfz_routes', {})
+    family('dfz_routes', 'gauge', 'Unique prefixes in the DFZ', [({'family': family_name}, routes)
+                                                                  for family_name, routes in dfz_routes.items()])
+    root_failures = gauges.get('atlas_roots', {}).get('root_failures', {})
+    family('root_server_failure_percent', 'gauge', 'RIPE Atlas probes failing to reach each root server',
+           [({'server': server, 'family': family_name}, percent)
+            for (server, family_name), percent in root_failures.items()])
+
+    latest = {source: runs[-1] for source, runs in timings.items()}
+    family('stage_duration_seconds', 'gauge', 'Wall time of each step of the latest run of a source',
+           [({'source': source, 'step': step}, timing['wall']) for source, steps in latest.items()
+            for step, timing in steps.items() if step != 'at'])
+    family('stage_cpu_seconds', 'gauge', 'CPU time of each step of the latest run of a source',
+           [({'source': source, 'step': step}, timing['cpu']) for source, steps in latest.items()
+            for step, timing in steps.items() if step != 'at'])
+    family('fetch_bytes', 'gauge', 'Bytes fetched by the latest run of a source',
+           [({'source': source}, sum(entry['bytes'] for entry in entries)) for source, entries in http_log.items()])
+    family('fetch_latency_seconds', 'gauge', 'Latency of each request made by the latest run of a source',
+           [({'source': source, 'url': entry['url']}, round(entry['latency'], 6))
+            for source, entries in http_log.items() for entry in entries])
+    family('fetch_attempts', 'gauge', 'Attempts each request made by the latest run of a source took',
+           [({'source': source, 'url': entry['url']}, entry['attempts'])
+            for source, entries in http_log.items() for entry in entries])
+
+    family('history_keys', 'gauge', 'Keys held in each history', [({'history': name}, len(history))
+                                                                   for name, history in histories.items()])
+    family('history_bytes', 'gauge', 'Bytes held by each history', [({'history': name}, history.nbytes())
+                                                                     for name, history in histories.items()])
+
+    family('writer_queue_depth', 'gauge', 'Publishes waiting on the output writer',
+           [({}, writer_stats.get('queue_depth'))])
+    family('writer_latency_seconds', 'gauge', 'From the latest publish handing its files over to them all being written',
+           [({}, writer_stats.get('latency'))])
+    family('writer_failures_total', 'counter', 'Publishes the output writer failed to write',
+           [({}, writer_stats.get('failures'))])
+    family('writer_pending_files', 'gauge', 'Files that failed to write, waiting to be retried with the next publish',
+           [({}, writer_stats.get('pending'))])
+
+    family('schedule_lateness_seconds', 'gauge', 'How late the latest run of a source started',
+           [({'source': source}, counts['lateness']) for source, counts in schedule.items()])
+    for counter in ('overruns', 'skipped', 'deadline_misses', 'failures'):
+        family(f"schedule_{counter}_total", 'counter', f"Runs of a source counted as {counter.replace('_', ' ')}",
+               [({'source': source}, counts[counter]) for source, counts in schedule.items()])
+
+    return ('\n'.join(families) + '\n').encode()
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics_exposition
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics():
+    """ Serves the metrics endpoint from a daemon thread, so it never holds up the collector or its exit """
+    try:
+        server = http.server.ThreadingHTTPServer((metrics_address, metrics_port), MetricsHandler)
+    except OSError as e:
         if debug:
-            print(status)
-            print(f"It took {duration.seconds} seconds to check fuckedness")
-            print(f"Weighted: {weighted_reasons} - Unweighted: {unweighted_reasons}")
+            print(f"failed to serve metrics on {metrics_address}:{metrics_port}: {e}")
+        return
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+
+
+def render_why(fucked_reasons, staleness):
+    why = ''
+    for metric, reasons in fucked_reasons.items():
+        if reasons:
+            if staleness.get(metric):
+                why += f"<h4>{metric} (stale, {staleness[metric] // 60} minutes old):</h4>\n"
+            else:
+                why += f"<h4>{metric}:</h4>\n"
+            why += '<ul class="why-list">'
+            for reason in sorted(reasons):
+                why += f"<li><var>{reason}</var>\n"
+            why += "</ul>"
+    return why
 
-        results['metrics'] = {'weighted': weighted_reasons, 'unweighted': unweighted_reasons}
 
-        if write_enabled:
-            with open(root + timestamp_file, 'w') as tf:
-                tf.write(datetime.now(timezone.utc).isoformat(timespec="seconds", sep=" ").replace("+00:00", "Z") + '\n')
-                tf.write(str(duration.seconds) + '\n')
+def render_timestamp(duration):
+    return datetime.now(timezone.utc).isoformat(timespec="seconds", sep=" ").replace("+00:00", "Z") + '\n' + \
+        f"{duration:.2f}\n"
 
-            with open(root + results_file, 'w') as rf:
-                ujson.dump(results, rf)
 
-        del results
+def render_index(status, why, timestamp):
+    """ Renders the page html/index.py prints from the same status, why and timestamp text, byte for byte,
+        minus its CGI header. Returns None when the header or footer can't be read """
 
-        if duration.seconds < update_frequency:
-            time.sleep(update_frequency - duration.seconds)
-        else:
-            pass    # We've taken long enough
+    try:
+        with open(root + header_file, 'r') as head:
+            header = head.read()
+        with open(root + footer_file, 'r') as foot:
+            footer = foot.read()
+    except OSError as e:
+        if debug:
+            print(f"not rendering {index_file}: {e}")
+        return None
+
+    # Read back as the text files would be, so the newlines print() leaves in are the same
+    checked, took = io.StringIO(timestamp).readlines()[:2]
+    page = [header,
+            '<header>',
+            '<p class="metadata">',
+            f'Fuckedness last checked {checked}</br>',
+            f'It took {took} seconds to checked fuckedness',
+            '</p>',
+            '</header>',
+            '<main class="wrapper">',
+            '<section class="fuckometer">',
+            f'<h1>{io.StringIO(status).read()}</h1>',
+            '</section>']
+    why = io.StringIO(why).readlines()
+    if why:
+        page += ['<section class="why">',
+                 '<h2>But why though?</h2>',
+                 '<h3 class="how-title">Calculation Metrics</h3>',
+                 '''<ul class="how">
+                <li>size of the DFZ and dramatic increase or decrease of prefixes
+                <li>number of origin AS per prefix
+                <li>RPKI ROA validity
+                <li>Dramatic decrease in published RPKI ROAs
+                <li>DNS root-server reachability
+                <li>RIPE Atlas probe connected status
+            </ul>''',
+                 '<h3>Specifically</h3>']
+        page += why
+        page += ['</p>',
+                 '</section>',
+                 '</main>',
+                 '<!--']
+    page.append(footer)
+
+    return ''.join(line + '\n' for line in page)
+
+
+def new_results_index():
+    """ Index of the detail documents, telling readers how keys are sharded and each document's sha1 and size """
+    return {'hash': 'crc32', 'shards': {name: results_shards for name in sharded_results}, 'documents': {}}
+
+
+def index_documents(documents, index):
+    """ Records changed detail documents in the index, returning them and the index as files to write """
+
+    files = {}
+    for path, (digest, body) in documents.items():
+        files[results_dir + path] = (digest, body)
+        index['documents'][path] = {'sha1': digest, 'bytes': len(body)}
+    files[results_dir + 'index.json'] = digested(ujson.dumps(index, sort_keys=True))
+
+    return files
+
+
+def write_file(path, content):
+    """ Writes a file under a temporary name and renames it into place, so readers only ever see a whole file """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w') as tf:
+        tf.write(content)
+    os.replace(path + '.tmp', path)
+
+
+def write_files(files):
+    """ Writes {path under root: (sha1, content)} in order, carrying on past a file that can't be written
+        A file whose content is None is removed, after everything else is written. Returns the paths that failed"""
+    failed = []
+    for path, (_, content) in sorted(files.items(), key=lambda file: file[1][1] is None):
+        try:
+            if content is None:
+                if os.path.exists(root + path):
+                    os.remove(root + path)
+                continue
+            write_file(root + path, content)
+        except OSError as e:
+            failed.append(path)
+            if debug:
+                print(f"failed to write {root + path}: {e}")
+    return failed
+
+
+def merge_files(files, later):
+    """ Adds later's files to files, replacing any already there. Each goes after everything handed over before it,
+        so a merged batch is written in the order its files were handed over, e.g. a delta before deltas.json """
+    for path, content in later.items():
+        files.pop(path, None)
+        files[path] = content
+    return files
+
+
+def skip_unchanged(files, written, last_changed):
+    """ Drops the files whose content is byte-identical to what was last written, so their mtime, and any
+        ETag derived from it, stay put. written holds the sha1 each file was last written with, filled in
+        from what's on disk the first time a file comes up, so restarts don't rewrite everything either.
+        Stamps the files that did change in last_changed"""
+
+    now = datetime.now(timezone.utc).isoformat(timespec="seconds")
+    changed = {}
+    for path, (digest, content) in files.items():
+        if path not in written:
+            try:
+                with open(root + path, 'rb') as ff:
+                    written[path] = hashlib.sha1(ff.read()).hexdigest()
+            except OSError:
+                written[path] = None
+        if written[path] == digest:
+            continue
+        changed[path] = (digest, content)
+        written[path] = digest
+        last_changed[path] = now
+
+    return changed
+
+
+class OutputWriter:
+    """ Write-behind for the site's files. Each publish hands over its files already rendered to strings,
+        which the writer thread writes out in order while the collector carries on
+        A file that fails to write is kept pending and retried ahead of the next publish's files, unless that
+        publish has a newer version of it. Detail documents and deltas are only ever handed over once, and
+        the index and feed already point at them, so they can't wait to be sent again"""
+
+    def __init__(self):
+        self.pending = {}
+        self.queue = queue.Queue()
+        self.stats = {'queue_depth': 0, 'latency': 0.0, 'write_time': 0.0, 'writes': 0, 'failures': 0, 'pending': 0}
+        self.thread = threading.Thread(target=self.run, name='writer', daemon=True)
+        self.thread.start()
+
+    def submit(self, files):
+        self.queue.put((time.monotonic(), files))
+        self.stats['queue_depth'] = self.queue.qsize()
+
+    def run(self):
+        while True:
+            submitted, files = self.queue.get()
+            if files is None:
+                return
+            files = merge_files(dict(self.pending), files)
+            # A writer that has fallen behind writes everything waiting as one, later publishes' files winning
+            while not self.queue.empty():
+                _, later = self.queue.get()
+                if later is None:
+                    self.queue.put((submitted, None))
+                    break
+                files = merge_files(files, later)
+            before = time.monotonic()
+            failed = write_files(files)
+            self.pending = {path: files[path] for path in failed}
+            if failed:
+                self.stats['failures'] += 1
+            else:
+                self.stats['writes'] += 1
+            # Latency is from the publish handing its files over to the last of them being in place
+            self.stats['write_time'] = round(time.monotonic() - before, 6)
+            self.stats['latency'] = round(time.monotonic() - submitted, 6)
+            self.stats['queue_depth'] = self.queue.qsize()
+            self.stats['pending'] = len(self.pending)
+
+    def close(self, timeout=30):
+        """ Lets the writer finish what's been handed to it, up to timeout seconds """
+        self.queue.put((time.monotonic(), None))
+        self.thread.join(timeout)
+
+
+def main():
+    global metrics_exposition
+
+    headers = {'User-Agent': 'howfuckedistheinternet.com'}
+
+    stages = {'bgp': run_bgp_stage, 'rpki': run_rpki_stage,
+              'atlas_roots': run_atlas_roots_stage, 'atlas_probes': run_atlas_probes_stage}
+    metrics = {'bgp': ['origins', 'prefixes', 'dfz'], 'rpki': ['invalid_roa', 'total_roa'],
+               'atlas_roots': ['dns_root'], 'atlas_probes': ['atlas_connected']}
+    enabled = {'bgp': bgp_enabled, 'rpki': rpki_enabled, 'atlas_roots': atlas_enabled, 'atlas_probes': atlas_enabled}
+
+    # Fork the BGP parse worker first, while this is still the only thread in the process. A replay
+    # parses in process, where the recording being replayed is
+    bgp_pool = None
+    if bgp_enabled and bgp_parse_worker and not replay_from:
+        bgp_pool = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('fork'))
+        bgp_pool.submit(int).result()
+
+    if metrics_enabled:
+        serve_metrics()
+
+    # The sources share no inputs, so their stages run side by side
+    stage_pool = ThreadPoolExecutor(max_workers=len(stages))
+    # The sha1 every output file was last written with, and when each last changed
+    written = {}
+    writer = OutputWriter() if write_enabled else None
+
+    histories = new_histories()
+
+    if persist_enabled:
+        before = time.monotonic()
+        if load_history(state_root + history_file, histories) and debug:
+            print(f"Restored history for {len(histories['origins'])} prefixes and {len(histories['prefixes'])} ASNs "
+                  f"in {time.monotonic() - before:.2f} seconds")
+
+    # The latest reasons and results from every source, each stage replaces its own as it delivers
+    scoreboard = Scoreboard(['origins', 'prefixes', 'dns_root', 'atlas_connected', 'invalid_roa', 'total_roa', 'dfz'])
+    # Sources that have missed their deadline, or failed, since they last delivered
+    overdue = set()
+    # Every detail document written and the digest it was written with, so unchanged ones are left alone
+    index = new_results_index()
+    changed_documents = {}
+    evictions = {}
+    # Latest and recent timings and counts of every fetch and check, per source
+    timings = {}
+    gauges = {}
+
+    # Delta feed: every publish that changes anything gets the next sequence number. A restart starts a new
+    # epoch, which tells consumers to resync from the full results rather than carry on applying deltas, so
+    # the last epoch's deltas are cleared out
+    feed = {'epoch': datetime.now(timezone.utc).isoformat(timespec="seconds"), 'seq': 0}
+    deltas = []
+    changes = {}
+    if write_enabled:
+        shutil.rmtree(root + deltas_dir, ignore_errors=True)
+        if os.path.exists(root + deltas_file):
+            os.remove(root + deltas_file)
+    last_score = None
+
+    # Digest of the upstream input each check last ran on, checks reuse their last reasons when it hasn't changed
+    state = {'histories': histories, 'input_digests': {}, 'last_reasons': scoreboard.reasons, 'bgp_pool': bgp_pool}
+
+    # Every source runs straight away, then on its wall clock aligned slots
+    next_run = {source: time.monotonic() for source in stages if enabled[source]}
+    running = {}
+    started = {}
+    schedule = {source: {'lateness': 0, 'overruns': 0, 'last_overrun': 0, 'skipped': 0,
+                         'deadline_misses': 0, 'failures': 0} for source in next_run}
+    duration = 0
+    why_stale = True
+    why = ''
+    try:
+        with open(root + last_changed_file, encoding='utf-8') as lf:
+            last_changed = ujson.load(lf)
+    except (OSError, ValueError):
+        last_changed = {}
+
+    # A replay runs each recorded stage in the order they were recorded, one at a time and without the clock
+    replay = replay_recordings(replay_from) if replay_from else None
+
+    try:
+        while True:
+            now = time.monotonic()
+            if replay is not None:
+                if not replay:
+                    break
+                source, path = replay.pop(0)
+                if source not in next_run:
+                    continue
+                replay_archives[source] = zipfile.ZipFile(path)
+                running[stage_pool.submit(run_stage, source, stages[source], headers, state)] = source
+                started[source] = now
+                done, _ = wait(running)
+                replay_archives.pop(source).close()
+                missed = []
+            else:
+                for source, due in next_run.items():
+                    if due > now:
+                        continue
+                    # A source still running from last time skips this slot rather than queueing up behind itself
+                    if source in running.values():
+                        schedule[source]['skipped'] += 1
+                    else:
+                        running[stage_pool.submit(run_stage, source, stages[source], headers, state)] = source
+                        started[source] = now
+                        schedule[source]['lateness'] = round(now - due, 3)
+                    next_run[source] = next_slot(schedules[source]['interval'])
+
+                # Wake for the next slot, or the next deadline of a stage that hasn't missed one yet
+                wake = min(next_run.values())
+                for source in running.values():
+                    if source not in overdue:
+                        wake = min(wake, started[source] + schedules[source]['deadline'])
+                timeout = max(0, wake - time.monotonic())
+                if not running:
+                    time.sleep(timeout)
+                    continue
+                done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+
+                # Publish on time regardless, with an overdue source's last reasons flagged as stale
+                now = time.monotonic()
+                missed = [source for future, source in running.items() if future not in done
+                          and source not in overdue and now >= started[source] + schedules[source]['deadline']]
+                if not done and not missed:
+                    continue
+
+            for source in missed:
+                if debug:
+                    print(f"{source} missed its {schedules[source]['deadline']} second deadline, carrying on with it")
+                schedule[source]['deadline_misses'] += 1
+                scoreboard.mark_stale(metrics[source])
+                overdue.add(source)
+                why_stale = True
+
+            for future in done:
+                source = running.pop(future)
+                overdue.discard(source)
+                try:
+                    stage = future.result()
+                except Exception as e:
+                    if debug:
+                        print(f"{source} failed: {e!r}")
+                    schedule[source]['failures'] += 1
+                    scoreboard.mark_stale(metrics[source])
+                    overdue.add(source)
+                    why_stale = True
+                    continue
+                for metric, reasons in stage['reasons'].items():
+                    why_stale |= scoreboard.update(metric, reasons)
+                # A stage that ran but couldn't check a metric (e.g. an empty BGP table) leaves it stale too
+                unchecked = [metric for metric in metrics[source] if metric not in stage['reasons']]
+                if unchecked:
+                    scoreboard.mark_stale(unchecked)
+                    why_stale = True
+                for path, document in stage['documents'].items():
+                    if index['documents'].get(path, {}).get('sha1') != document[0]:
+                        changed_documents[path] = document
+                changes.update(stage.get('changes', {}))
+                evictions.update(stage['evictions'])
+                stage['timings']['at'] = datetime.now(timezone.utc).isoformat(timespec="seconds")
+                timings[source] = (timings.get(source, []) + [stage['timings']])[-timings_history:]
+                # A stage that skipped its checks, because its input hadn't changed, leaves its last gauges in place
+                gauges[source] = stage.get('gauges', gauges.get(source, {}))
+                duration = time.monotonic() - started[source]
+                if debug:
+                    print(f"It took {duration:.1f} seconds to check {source}")
+                if duration > schedules[source]['interval']:
+                    schedule[source]['overruns'] += 1
+                    schedule[source]['last_overrun'] = round(duration - schedules[source]['interval'], 3)
+
+            # Re-score whenever any source delivers, only rewriting the outputs that actually changed
+            staleness = scoreboard.staleness()
+            added, resolved = scoreboard.take_changes()
+            score = (scoreboard.status, scoreboard.weighted_reasons, scoreboard.unweighted_reasons)
+            stage_history = ujson.dumps(timings)
+            stage_history = digested(stage_history)
+            if index['documents'].get('metrics/stage_history.json', {}).get('sha1') != stage_history[0]:
+                changed_documents['metrics/stage_history.json'] = stage_history
+            documents = {path: document[0] for path, document in changed_documents.items()}
+            # Every history pushed to since the last publish, which consumers apply to their copy of it. None
+            # rather than a huge list (e.g. the first table after a start), the changed documents cover it
+            samples = {name: change if len(change['latest']) + len(change['held']) + len(change['evicted'])
+                       <= delta_keys_limit else None for name, change in changes.items()}
+            delta = None
+            pruned = []
+            if added or resolved or documents or samples or score != last_score:
+                feed['seq'] += 1
+                delta = {'epoch': feed['epoch'], 'seq': feed['seq'],
+                         'at': datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                         'status': scoreboard.status, 'weighted': scoreboard.weighted_reasons,
+                         'unweighted': scoreboard.unweighted_reasons, 'added': added, 'resolved': resolved,
+                         'samples': samples, 'documents': documents}
+                deltas.append(feed['seq'])
+                pruned, deltas = deltas[:-deltas_kept], deltas[-deltas_kept:]
+                last_score = score
+            changes = {}
+
+            summary = {'status': scoreboard.status,
+                       'metrics': {'weighted': scoreboard.weighted_reasons,
+                                   'unweighted': scoreboard.unweighted_reasons,
+                                   'updated': scoreboard.updated,
+                                   'stale': staleness,
+                                   'schedule': schedule, 'evictions': evictions,
+                                   'http': http_log,
+                                   'stages': {source: runs[-1] for source, runs in timings.items()},
+                                   'documents_written': len(changed_documents),
+                                   'writer': dict(writer.stats) if writer else None},
+                       'index': results_dir + 'index.json',
+                       'feed': dict(feed)}
+
+            metrics_exposition = render_metrics(scoreboard, schedule, timings, gauges, histories,
+                                                writer.stats if writer else {})
+
+            if debug:
+                print(scoreboard.status)
+                print(f"Weighted: {scoreboard.weighted_reasons} - Unweighted: {scoreboard.unweighted_reasons}")
+
+            # Everything handed to the writer is a string, so nothing it holds changes under it
+            if write_enabled:
+                files = {status_file: digested(scoreboard.status + '\n')}
+                if why_stale:
+                    why = render_why(scoreboard.reasons, staleness)
+                    files[why_file] = digested(why)
+                    # Stale reasons are rewritten every publish so their age stays current
+                    why_stale = bool(staleness)
+                if changed_documents:
+                    files.update(index_documents(changed_documents, index))
+                files[results_file] = digested(ujson.dumps(summary))
+                if deltas:
+                    files[deltas_file] = digested(ujson.dumps({'epoch': feed['epoch'], 'first': deltas[0],
+                                                               'last': feed['seq'],
+                                                               'path': deltas_dir + '{seq}.json'}))
+                changed = skip_unchanged(files, written, last_changed)
+                # A new delta is in place before deltas.json points at it, and old ones go once it no longer does
+                files = {deltas_dir + f"{delta['seq']}.json": digested(ujson.dumps(delta))} if delta else {}
+                files.update(changed)
+                files.update({deltas_dir + f"{seq}.json": (None, None) for seq in pruned})
+                # timestamp.txt is when fuckedness was last checked so goes out every publish, with
+                # last_changed.json alongside it whenever any of the other files did change
+                if changed:
+                    files[last_changed_file] = digested(ujson.dumps(last_changed, sort_keys=True))
+                timestamp = render_timestamp(duration)
+                files[timestamp_file] = digested(timestamp)
+                # index.html shows the timestamp too, so it's rendered alongside it rather than only on changes
+                page = render_index(scoreboard.status + '\n', why, timestamp)
+                if page is not None:
+                    files[index_file] = digested(page)
+                writer.submit(files)
+            changed_documents = {}
+
+    finally:
+        stage_pool.shutdown(cancel_futures=True)
+        if writer:
+            writer.close()
+        if bgp_pool:
+            bgp_pool.shutdown(cancel_futures=True)
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Checks how fucked the Internet is')
+    parser.add_argument('--record', action='store_true', help='archive every upstream response for replay')
+    parser.add_argument('--replay', metavar='DIR', help='run the checks over recordings instead of fetching upstream')
+    parser.add_argument('--upstream', metavar='URL', help='fetch every source from one stand-in, e.g. mock_upstream.py')
+    parser.add_argument('--output', metavar='DIR', help=f"write the site's files to DIR instead of {root}, "
+                                                        f"required with --replay")
+    args = parser.parse_args()
+    if args.replay and not args.output:
+        parser.error('--replay needs --output, so a replay never overwrites the live site')
+
+    if args.upstream:
+        bgp_table_url = args.upstream.rstrip('/') + '/table.jsonl'
+        routinator_api_url = args.upstream.rstrip('/') + '/api/v1/status'
+        ripe_atlas_api_url = args.upstream.rstrip('/') + '/measurements/'
+
+    record_enabled = record_enabled or args.record
+    if args.replay:
+        # Replaying mustn't leave its history, or more recordings, in place of the live ones, nor take
+        # over the live collector's metrics port
+        replay_from = args.replay
+        record_enabled = False
+        persist_enabled = False
+        metrics_enabled = False
+    if args.output:
+        root = os.path.join(args.output, '')
     main()
 
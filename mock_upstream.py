@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+""" Local stand-in for bgp.tools, Routinator and RIPE Atlas, for load testing the fetchers in main.py
+    Serves synthetic payloads, or the latest recorded ones from main.py --record, with configurable
+    per-source latency, bandwidth, error rates and hangs. Point main.py at it with --upstream"""
+import argparse
+import hashlib
+import http.server
+import ipaddress
+import random
+import sys
+import time
+import ujson
+import zipfile
+
+import main
+
+listen_address = '127.0.0.1'
+listen_port = 8770
+seed = 1
+routes = 10000                  # Routes in the synthetic table.jsonl
+moas_share = 0.02               # Share of synthetic prefixes originated by more than one ASN
+repos = 5                       # Repositories in the synthetic Routinator status
+atlas_probes = 1000             # Probes in each synthetic Atlas measurement
+root_failure_rate = 0.05        # Share of probes failing each root server measurement
+probe_disconnect_rate = 0.05    # Share of probes disconnected in measurement 7000
+write_chunk_size = 16384        # Bytes written at a time, the granularity bandwidth caps are applied at
+hang_time = 300                 # Seconds a hung request holds its connection open before dropping it
+debug = True
+
+# Injected per source. latency: seconds before responding, bandwidth: bytes per second (None is uncapped),
+# error_rate: share of requests answered 503, hang_rate: share of requests never answered
+faults = {source: {'latency': 0, 'bandwidth': None, 'error_rate': 0, 'hang_rate': 0}
+          for source in ('bgp', 'rpki', 'atlas_roots', 'atlas_probes')}
+
+# Path, without any trailing slash -> (source, body), built once at startup
+payloads = {}
+
+root_measurements = [10001, 10004, 10005, 10008, 10009, 10010, 10011, 10012, 10013, 10014, 10015, 10016,
+                     10501, 10504, 10505, 10506, 10508, 10509, 10510, 10511, 10512, 10513, 10514, 10515, 10516]
+
+
+def synthetic_table(rng):
+    """ table.jsonl lines for a mix of v4 /24s and v6 /48s, a few of them originated by several ASNs """
+    lines = []
+    v4 = int(ipaddress.IPv4Address('11.0.0.0')) >> 8
+    v6 = int(ipaddress.IPv6Address('2a00::')) >> 80
+    n = 0
+    while n < routes:
+        if n % 5:
+            cidr = f"{ipaddress.IPv4Address((v4 + n) << 8)}/24"
+        else:
+            cidr = f"{ipaddress.IPv6Address((v6 + n) << 80)}/48"
+        origins = rng.randint(2, 4) if rng.random() < moas_share else 1
+        for asn in rng.sample(range(1, 65000), origins):
+            lines.append(ujson.dumps({'CIDR': cidr, 'ASN': asn, 'Hits': rng.randint(1, 1000)}))
+        n += origins
+    return ('\n'.join(lines) + '\n').encode()
+
+
+def synthetic_rpki(rng):
+    repositories = {}
+    for i in range(repos):
+        repositories[f"rsync://rpki.repo{i}.example/repository/"] = {'validROAs': rng.randint(1000, 50000),
+                                                                      'invalidROAs': rng.randint(0, 50)}
+    return ujson.dumps({'repositories': repositories}).encode()
+
+
+def synthetic_root_measurement(rng):
+    return ujson.dumps([{'prb_id': probe, 'error': {'timeout': 5000} if rng.random() < root_failure_rate else None}
+                        for probe in range(atlas_probes)]).encode()
+
+
+def synthetic_probe_status(rng):
+    return ujson.dumps([{'prb_id': probe, 'event': 'disconnect' if rng.random() < probe_disconnect_rate else 'connect'}
+                        for probe in range(atlas_probes)]).encode()
+
+
+def upstream_paths():
+    """ Path served -> (source, the url main.py fetches it from upstream) """
+    paths = {'/table.jsonl': ('bgp', main.bgp_table_url),
+             '/api/v1/status': ('rpki', main.routinator_api_url),
+             '/measurements/7000/latest': ('atlas_probes', main.ripe_atlas_api_url + '7000/latest')}
+    for measurement in root_measurements:
+        paths[f"/measurements/{measurement}/latest/"] = ('atlas_roots', f"{main.ripe_atlas_api_url}{measurement}/latest/")
+    return paths
+
+
+def load_payloads(recordings=None):
+    """ Builds every payload, from the latest recording of each source when given a recordings directory """
+
+    rng = random.Random(seed)
+    paths = upstream_paths()
+    for path, (source, url) in paths.items():
+        if source == 'bgp':
+            body = synthetic_table(rng)
+        elif source == 'rpki':
+            body = synthetic_rpki(rng)
+        elif source == 'atlas_probes':
+            body = synthetic_probe_status(rng)
+        else:
+            body = synthetic_root_measurement(rng)
+        payloads[path.rstrip('/')] = (source, body)
+
+    if not recordings:
+        return
+
+    latest = {}
+    for source, path in main.replay_recordings(recordings):
+        latest[source] = path
+    for source, path in latest.items():
+        with zipfile.ZipFile(path) as zf:
+            for served, (served_source, url) in paths.items():
+                entry = main.recorded_entry(zf, url) if served_source == source else None
+                if entry is not None:
+                    payloads[served.rstrip('/')] = (source, zf.read(entry))
+        if debug:
+            print(f"serving {source} from {path}")
+
+
+class MockUpstream(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        payload = payloads.get(self.path.split('?')[0].rstrip('/'))
+        if payload is None:
+            self.reply(404)
+            return
+
+        source, body = payload
+        fault = faults[source]
+        if fault['latency']:
+            time.sleep(fault['latency'])
+        if random.random() < fault['hang_rate']:
+            time.sleep(hang_time)
+            self.close_connection = True
+            return
+        if random.random() < fault['error_rate']:
+            self.reply(503)
+            return
+
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        if self.headers.get('If-None-Match') == etag:
+            self.reply(304, etag=etag)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        try:
+            for offset in range(0, len(body), write_chunk_size):
+                self.wfile.write(body[offset:offset + write_chunk_size])
+                if fault['bandwidth']:
+                    time.sleep(write_chunk_size / fault['bandwidth'])
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def reply(self, status, etag=None):
+        self.send_response(status)
+        if etag:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        if debug:
+            sys.stderr.write(f"{self.address_string()} {format % args}\n")
+
+
+def parse_faults(option, values, cast):
+    """ Applies source=value settings for one fault, 'all' sets it for every source """
+    for setting in values or []:
+        source, _, value = setting.partition('=')
+        for name in (faults if source == 'all' else [source]):
+            if name not in faults:
+                sys.exit(f"unknown source {source} for --{option}, expected one of {', '.join(faults)} or all")
+            faults[name][option.replace('-', '_')] = cast(value)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for the upstreams main.py fetches from')
+    parser.add_argument('--port', type=int, default=listen_port)
+    parser.add_argument('--recordings', metavar='DIR', help='serve the latest recording of each source')
+    parser.add_argument('--routes', type=int, default=routes, help='routes in the synthetic BGP table')
+    parser.add_argument('--quiet', action='store_true')
+    for option in ('latency', 'bandwidth', 'error-rate', 'hang-rate'):
+        parser.add_argument(f"--{option}", action='append', metavar='SOURCE=VALUE',
+                            help=f"{option} for bgp, rpki, atlas_roots, atlas_probes or all, may be repeated")
+    args = parser.parse_args()
+
+    routes = args.routes
+    debug = not args.quiet
+    parse_faults('latency', args.latency, float)
+    parse_faults('bandwidth', args.bandwidth, float)
+    parse_faults('error-rate', args.error_rate, float)
+    parse_faults('hang-rate', args.hang_rate, float)
+
+    load_payloads(args.recordings)
+    if debug:
+        print(f"serving {len(payloads)} payloads on http://{listen_address}:{args.port}, faults {faults}")
+
+    server = http.server.ThreadingHTTPServer((listen_address, args.port), MockUpstream)
+    server.daemon_threads = True
+    server.serve_forever()